@@ -1,8 +1,33 @@
 import bpy
+from bpy_extras.object_utils import world_to_camera_view
 from collections import defaultdict
+import hashlib
+import json
 import math
 import mathutils
+from multiprocessing import cpu_count
+from multiprocessing.pool import ThreadPool
 import os
+import shutil
+import struct
+import subprocess
+import sys
+import tempfile
+
+
+# where the images go when the operator has no output path, the finishing
+# app looks here too (see chophumanfinisher.importers.rendermanifest)
+RENDER_DIRECTORY = os.path.join(tempfile.gettempdir(), 'chophuman')
+SCENE_LAYER_COUNT = 20
+# pixels of margin around the projected bounds of a limb when cropping
+CROP_PADDING = 4
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_VERSION = 1
+# the suffix of the image filenames of each render pass
+PASS_SUFFIXES = {
+    'diffuse': '',
+    'normal': '_normal_material',
+}
 
 
 # Define limb parts based on vertex groups
@@ -97,6 +122,8 @@ TORSO_PARTS = prefix_dfm(
     'Stomach',
     'Trap2',
 )
+# the limbs are named after the bones of the finishing app's skeleton
+LIMB_PREFIX = 'chop_'
 LIMB_CONFIG = [ # order for painter's algorithm
     ('chop_left_arm', make_group_side_names('L', ARM_PARTS)),      
     ('chop_left_hand', make_group_side_names('L', HAND_PARTS)),
@@ -115,6 +142,21 @@ LIMB_CONFIG = [ # order for painter's algorithm
     ('chop_right_arm', make_group_side_names('R', ARM_PARTS)),
     ('chop_right_hand', make_group_side_names('R', HAND_PARTS)),
 ]
+# the armature bone each limb pivots around
+LIMB_PIVOT_BONES = {
+    'chop_left_arm': 'UpArm_L',
+    'chop_left_hand': 'Hand_L',
+    'chop_left_foot': 'Foot_L',
+    'chop_left_lower_leg': 'LoLeg_L',
+    'chop_left_upper_leg': 'UpLeg_L',
+    'chop_head': 'Head',
+    'chop_torso': 'Hips',
+    'chop_right_foot': 'Foot_R',
+    'chop_right_lower_leg': 'LoLeg_R',
+    'chop_right_upper_leg': 'UpLeg_R',
+    'chop_right_arm': 'UpArm_R',
+    'chop_right_hand': 'Hand_R',
+}
 
 
 def pose_human(obj):
@@ -159,34 +201,42 @@ def create_normalmap_material(material_name='normal_material'):
     return material
 
 
-def create_limb_groups(obj, new_group_name, group_names, threshold=0.3):
+def find_limb_vertices(obj, limb_config, threshold=0.3):
     """
-    Aggregates the named vertex groups on this object into one large group which
-    is associated with a MaskModifier to isolate the limb during rendering.
+    Returns a list with the indices of the vertices of each limb in limb_config,
+    i.e. those weighted at least threshold in one of the limb's vertex groups.
+    The group memberships of each vertex are read once for all of the limbs.
     """
-    original_groups = obj.vertex_groups
-    relevant_groups = []
-    for group_name in group_names:
-        this_group = original_groups.get(group_name)
-        if this_group is None:
-            continue
-        relevant_groups.append(this_group)
-    mesh = obj.data       
-    meta_group = obj.vertex_groups.new(name=new_group_name)
-    indices = set()
-    for vert in mesh.vertices:
-        for group in relevant_groups:
-            try:
-                this_weight = group.weight(vert.index)
-            except RuntimeError: # vertex not in group
-                this_weight = -100.0
-            if this_weight >= threshold:
-                indices.add(vert.index)
-    print('adding group and mask %s' % (meta_group.name))
-    meta_group.add(list(indices), 1.0, 'ADD')
-    mask_modifier = obj.modifiers.new('LimbMask_' + meta_group.name, 'MASK')
-    mask_modifier.vertex_group = meta_group.name
-    mask_modifier.show_render = mask_modifier.show_viewport = False
+    # vertex group index -> indices of the limbs it belongs to
+    group_limbs = defaultdict(list)
+    for limb_index, (limb_group_name, group_names) in enumerate(limb_config):
+        for group_name in group_names:
+            this_group = obj.vertex_groups.get(group_name)
+            if this_group is not None:
+                group_limbs[this_group.index].append(limb_index)
+    limb_indices = [set() for _ in limb_config]
+    for vert in obj.data.vertices:
+        for element in vert.groups:
+            limbs = group_limbs.get(element.group)
+            if limbs and element.weight >= threshold:
+                for limb_index in limbs:
+                    limb_indices[limb_index].add(vert.index)
+    return [sorted(indices) for indices in limb_indices]
+
+
+def create_limb_groups(obj, limb_config, threshold=0.3):
+    """
+    Aggregates the named vertex groups of each limb on this object into one large
+    group which is associated with a MaskModifier to isolate the limb during rendering.
+    """
+    limb_vertices = find_limb_vertices(obj, limb_config, threshold)
+    for (new_group_name, group_names), indices in zip(limb_config, limb_vertices):
+        meta_group = obj.vertex_groups.new(name=new_group_name)
+        print('adding group and mask %s' % (meta_group.name))
+        meta_group.add(indices, 1.0, 'ADD')
+        mask_modifier = obj.modifiers.new('LimbMask_' + meta_group.name, 'MASK')
+        mask_modifier.vertex_group = meta_group.name
+        mask_modifier.show_render = mask_modifier.show_viewport = False
 
 
 def arrange_scene_for_rendering(scene, flat_shaded=False):
@@ -199,6 +249,7 @@ def arrange_scene_for_rendering(scene, flat_shaded=False):
     render.use_full_sample = True
     render.use_shadows = not flat_shaded
     render.resolution_x, render.resolution_y = (1080, 1920)
+    render.use_border = False
     camera = bpy.data.cameras['Camera']
     camera.type = 'ORTHO'
     camera.ortho_scale = 28.0 # magic
@@ -213,33 +264,132 @@ def arrange_scene_for_rendering(scene, flat_shaded=False):
     light_obj.rotation_euler = (0.0, math.radians(-45.0), 0.0)
 
 
-def render_limbs(objs, limb_group_names, normal_maps=False, flat_shaded=False):
+def render_size(scene):
+    """ The size in pixels of the full rendered frame. """
+    render = scene.render
+    scale = render.resolution_percentage / 100.0
+    return int(render.resolution_x * scale), int(render.resolution_y * scale)
+
+
+def limb_crop_region(scene, objs, limb_group_name, padding=CROP_PADDING):
+    """
+    Returns the (left, top, right, bottom) pixel bounds of the limb in the rendered
+    frame, measured from the top left, or None if none of its vertices are left.
+    The limb's vertices are projected into the camera as they'll be rendered, i.e.
+    posed and with only the limb's mask shown.
+    """
+    _show_limb(objs, limb_group_name)
+    camera = scene.camera
+    xs = []
+    ys = []
+    for obj in objs:
+        if 'LimbMask_' + limb_group_name not in obj.modifiers:
+            continue
+        mesh = obj.to_mesh(scene, True, 'RENDER')
+        try:
+            matrix = obj.matrix_world
+            for vert in mesh.vertices:
+                co = world_to_camera_view(scene, camera, matrix * vert.co)
+                xs.append(co.x)
+                ys.append(co.y)
+        finally:
+            bpy.data.meshes.remove(mesh)
+    if not xs:
+        return None
+    width, height = render_size(scene)
+    left = max(0, int(math.floor(min(xs) * width)) - padding)
+    right = min(width, int(math.ceil(max(xs) * width)) + padding)
+    # camera view coordinates go up, image rows down
+    top = max(0, int(math.floor((1.0 - max(ys)) * height)) - padding)
+    bottom = min(height, int(math.ceil((1.0 - min(ys)) * height)) + padding)
+    if left >= right or top >= bottom:
+        return None
+    return left, top, right, bottom
+
+
+def union_region(regions):
+    regions = [region for region in regions if region is not None]
+    if not regions:
+        return None
+    lefts, tops, rights, bottoms = zip(*regions)
+    return min(lefts), min(tops), max(rights), max(bottoms)
+
+
+def _set_render_region(scene, region):
+    """
+    Renders only the given (left, top, right, bottom) pixels of the frame, cropping
+    the image to them, or the whole frame if region is None.
+    """
+    render = scene.render
+    if region is None:
+        render.use_border = False
+        return
+    width, height = render_size(scene)
+    left, top, right, bottom = region
+    render.use_border = True
+    render.use_crop_to_border = True
+    # the border is truncated to whole pixels; aim for their middle so that it
+    # lands on the intended ones. Border y goes up from the bottom of the frame.
+    render.border_min_x = (left + 0.5) / width
+    render.border_max_x = min(1.0, (right + 0.5) / width)
+    render.border_min_y = (height - bottom + 0.5) / height
+    render.border_max_y = min(1.0, (height - top + 0.5) / height)
+
+
+def render_limbs(objs, limb_group_names, normal_maps=False, flat_shaded=False,
+                 target_directory=RENDER_DIRECTORY, crop=False):
     """
     Renders each limb in isolation using the masks we created earlier.
+    With crop, only the part of the frame the limb covers is rendered.
     """
     scene = bpy.context.scene
     arrange_scene_for_rendering(scene, flat_shaded=flat_shaded)
-    _render_limbs_force_material(
-        objs, limb_group_names, flat_shaded=flat_shaded)
+    regions = [None] * len(limb_group_names)
+    if crop:
+        regions = [limb_crop_region(scene, objs, name) for name in limb_group_names]
+    entries = _render_limbs_force_material(
+        objs, limb_group_names, regions, flat_shaded=flat_shaded,
+        target_directory=target_directory)
     if normal_maps:
-        _render_normalmaps(objs, limb_group_names, )
+        entries += _render_normalmaps(objs, limb_group_names, regions, target_directory)
+    _set_render_region(scene, None)
+    write_manifest(scene, objs, target_directory, entries)
 
 
-def _render_normalmaps(objs, limb_group_names):
+def _render_normalmaps(objs, limb_group_names, regions, target_directory=RENDER_DIRECTORY):
     """
     Creates a normal map material and renders all the limbs with it.
     """
     normalmap_material = create_normalmap_material()
-    _render_limbs_force_material(objs, limb_group_names, material=normalmap_material)
+    return _render_limbs_force_material(
+        objs, limb_group_names, regions, material=normalmap_material, pass_name='normal',
+        target_directory=target_directory)
 
 
-def _render_limbs_force_material(objs, limb_group_names, material=None, flat_shaded=False):
+def _render_limbs_force_material(objs, limb_group_names, regions, material=None,
+                                 flat_shaded=False, pass_name='diffuse',
+                                 target_directory=RENDER_DIRECTORY):
     """
-    Renders each limb in isolation using the masks we created earlier.
+    Renders each limb in isolation using the masks we created earlier, within its
+    region of the frame (see limb_crop_region).
     Allows the mesh material to be overridden and for optional shadeless rendering.
+    Returns the manifest entries of the rendered images.
     """
     scene = bpy.context.scene
-    # hide all the limbs and optionally add the normalmap material
+    _prepare_limb_objects(objs, material=material, flat_shaded=flat_shaded)
+    # render each limb in isolation
+    entries = []
+    for limb_index, limb_group_name in enumerate(limb_group_names):
+        entries.append(_render_limb(
+            scene, objs, limb_index, limb_group_name, pass_name, target_directory,
+            regions[limb_index]))
+    return entries
+
+
+def _prepare_limb_objects(objs, material=None, flat_shaded=False):
+    """
+    Hides all the limbs and optionally adds the material to the meshes.
+    """
     for obj in objs:
         for modifier in obj.modifiers:
             if modifier.name.startswith('LimbMask_'):
@@ -255,31 +405,303 @@ def _render_limbs_force_material(objs, limb_group_names, material=None, flat_sha
             for face in mesh.polygons:
                 face.material_index = material_index
 
-    # render each limb in isolation
-    last_modifiers = []
-    for limb_index, limb_group_name in enumerate(limb_group_names):
-        # hide the previously displayed limb
-        while last_modifiers:
-            modifier = last_modifiers.pop()
-            modifier.show_render = modifier.show_viewport = False
-        for obj in objs:
+
+def _show_limb(objs, limb_group_name):
+    """ Shows only the mask modifiers of the given limb. """
+    mask_name = 'LimbMask_' + limb_group_name
+    for obj in objs:
+        for modifier in obj.modifiers:
+            if modifier.name.startswith('LimbMask_'):
+                visible = modifier.name == mask_name
+                modifier.show_render = modifier.show_viewport = visible
+
+
+def _render_limb(scene, objs, limb_index, limb_group_name, pass_name, target_directory,
+                 region=None):
+    """
+    Shows only the given limb, renders it and returns its manifest entry.
+    """
+    _show_limb(objs, limb_group_name)
+    _set_render_region(scene, region)
+    filename = limb_filename(limb_index, limb_group_name, pass_name)
+    scene.render.filepath = os.path.join(target_directory, filename)
+    bpy.ops.render.render(write_still=True)
+    return manifest_entry(limb_index, limb_group_name, pass_name, filename, region)
+
+
+def limb_filename(limb_index, limb_group_name, pass_name='diffuse'):
+    return '%03d_%s%s.png' % (limb_index, limb_group_name, PASS_SUFFIXES[pass_name])
+
+
+def manifest_entry(limb_index, limb_group_name, pass_name, filename, region=None):
+    """
+    Describes a rendered image. Its offset is the position of its top left corner
+    in the full frame, for images cropped to a region.
+    """
+    left, top = region[:2] if region else (0, 0)
+    return {
+        'index': limb_index,
+        'limb': limb_group_name,
+        'pass': pass_name,
+        'filename': filename,
+        'offset': [left, top],
+    }
+
+
+def write_manifest(scene, objs, target_directory, entries):
+    """
+    Writes the list of rendered images next to them, for the finishing app. Besides
+    what the entries say, each image is listed with the bone it belongs to, the
+    position of that bone's pivot in the frame, its size and a hash of its file.
+    Images which weren't written are left out.
+    """
+    frame_size = render_size(scene)
+    pivots = {}
+    images = []
+    for entry in sorted(entries, key=lambda entry: (entry['pass'], entry['index'])):
+        filepath = os.path.join(target_directory, entry['filename'])
+        try:
+            with open(filepath, 'rb') as image_file:
+                data = image_file.read()
+        except IOError:
+            continue
+        limb_group_name = entry['limb']
+        if limb_group_name not in pivots:
+            pivots[limb_group_name] = limb_pivot(scene, objs, limb_group_name)
+        entry = dict(entry)
+        entry['bone'] = limb_group_name[len(LIMB_PREFIX):]
+        entry['pivot'] = pivots[limb_group_name]
+        entry['size'] = list(_png_size(data) or frame_size)
+        entry['hash'] = hashlib.sha1(data).hexdigest()
+        images.append(entry)
+    manifest = {
+        'version': MANIFEST_VERSION,
+        'frame_size': list(frame_size),
+        'images': images,
+    }
+    with open(os.path.join(target_directory, MANIFEST_FILENAME), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=1, sort_keys=True)
+
+
+def limb_pivot(scene, objs, limb_group_name):
+    """
+    Returns the [x, y] pixel position in the rendered frame of the head of the
+    bone the limb pivots around, or None if the armature doesn't have it.
+    """
+    bone_name = LIMB_PIVOT_BONES.get(limb_group_name)
+    for obj in objs:
+        armature = obj.parent
+        if armature is None or armature.type != 'ARMATURE':
+            continue
+        pose_bone = armature.pose.bones.get(bone_name)
+        if pose_bone is None:
+            continue
+        co = world_to_camera_view(scene, scene.camera, armature.matrix_world * pose_bone.head)
+        width, height = render_size(scene)
+        return [round(co.x * width, 2), round((1.0 - co.y) * height, 2)]
+    return None
+
+
+def _png_size(data):
+    """ Returns the (width, height) in the header of PNG data, or None. """
+    if data[:8] != b'\x89PNG\r\n\x1a\n' or len(data) < 24:
+        return None
+    return struct.unpack('>II', data[16:24])
+
+
+def render_limbs_in_background(objs, limb_group_names, jobs, normal_maps=False,
+                               flat_shaded=False, target_directory=RENDER_DIRECTORY,
+                               crop=False):
+    """
+    Renders the limbs like render_limbs, but each (limb, pass) in a separate
+    `blender --background` process with up to `jobs` of them running at once, so
+    that the whole character takes about as long as its slowest limb. The chopped
+    scene is saved once to a temporary .blend file which the workers open; the
+    render threads are split between them.
+    """
+    scene = bpy.context.scene
+    arrange_scene_for_rendering(scene, flat_shaded=flat_shaded)
+    regions = [None] * len(limb_group_names)
+    if crop:
+        regions = [limb_crop_region(scene, objs, name) for name in limb_group_names]
+    _prepare_limb_objects(objs, flat_shaded=flat_shaded)
+    work_directory = tempfile.mkdtemp(prefix='chophuman_')
+    blend_filepath = os.path.join(work_directory, 'chopped.blend')
+    bpy.ops.wm.save_as_mainfile(filepath=blend_filepath, copy=True)
+    pass_names = ['diffuse', 'normal'] if normal_maps else ['diffuse']
+    tasks = [
+        (limb_index, limb_group_name, pass_name)
+        for pass_name in pass_names
+        for limb_index, limb_group_name in enumerate(limb_group_names)
+    ]
+    jobs = max(1, min(jobs, len(tasks)))
+    threads = max(1, cpu_count() // jobs)
+
+    def run_worker(task):
+        limb_index, limb_group_name, pass_name = task
+        command = [
+            bpy.app.binary_path, '--background', blend_filepath,
+            '--threads', str(threads),
+            '--python', os.path.abspath(__file__), '--',
+            target_directory, str(limb_index), limb_group_name, pass_name,
+            ','.join(str(value) for value in regions[limb_index] or ()),
+        ] + [obj.name for obj in objs]
+        log_filepath = os.path.join(work_directory, '%03d_%s.log' % (limb_index, pass_name))
+        with open(log_filepath, 'w') as log_file:
+            returncode = subprocess.call(command, stdout=log_file, stderr=subprocess.STDOUT)
+        if returncode != 0:
+            with open(log_filepath) as log_file:
+                print(log_file.read())
+        return returncode
+
+    pool = ThreadPool(jobs)
+    try:
+        returncodes = pool.map(run_worker, tasks)
+    finally:
+        pool.close()
+        pool.join()
+        shutil.rmtree(work_directory, ignore_errors=True)
+    entries = []
+    failed = []
+    for (limb_index, limb_group_name, pass_name), returncode in zip(tasks, returncodes):
+        if returncode != 0:
+            failed.append('%s (%s)' % (limb_group_name, pass_name))
+            continue
+        filename = limb_filename(limb_index, limb_group_name, pass_name)
+        entries.append(manifest_entry(
+            limb_index, limb_group_name, pass_name, filename, regions[limb_index]))
+    write_manifest(scene, objs, target_directory, entries)
+    if failed:
+        raise RuntimeError('Rendering failed for %s' % ', '.join(failed))
+
+
+def _render_worker(argv):
+    """
+    Renders one limb of the chopped scene this background process was started
+    with; see render_limbs_in_background.
+    """
+    target_directory, limb_index, limb_group_name, pass_name, region = argv[:5]
+    scene = bpy.context.scene
+    objs = [bpy.data.objects[name] for name in argv[5:]]
+    region = tuple(int(value) for value in region.split(',')) if region else None
+    if pass_name == 'normal':
+        _prepare_limb_objects(objs, material=create_normalmap_material())
+    _render_limb(
+        scene, objs, int(limb_index), limb_group_name, pass_name, target_directory, region)
+
+
+def render_limbs_single_pass(objs, limb_group_names, normal_maps=False, flat_shaded=False,
+                             target_directory=RENDER_DIRECTORY, crop=False):
+    """
+    Renders the same images as render_limbs with a single render. Each limb gets a
+    copy of the meshes showing only that limb on a scene layer of its own, and a
+    render layer which sees only that scene layer (plus one with the normal map
+    material for each limb), so the scene is set up and converted once for all of
+    them. The limbs keep the parts other limbs hide, as they would when rendered
+    in isolation. A File Output node in the compositor writes each render layer
+    to its image. There is one render region for all of the layers, so with crop
+    every image is cropped to the bounds of the whole body.
+    """
+    scene = bpy.context.scene
+    arrange_scene_for_rendering(scene, flat_shaded=flat_shaded)
+    region = None
+    if crop:
+        region = union_region(
+            limb_crop_region(scene, objs, name) for name in limb_group_names)
+    _prepare_limb_objects(objs, flat_shaded=flat_shaded)
+    used_layers = set(
+        index for obj in scene.objects
+        for index, used in enumerate(obj.layers) if used)
+    free_layers = [index for index in range(SCENE_LAYER_COUNT) if index not in used_layers]
+    if len(free_layers) < len(limb_group_names):
+        raise RuntimeError(
+            'Rendering in one pass needs %d empty scene layers' % len(limb_group_names))
+    pass_materials = [('diffuse', None)]
+    if normal_maps:
+        pass_materials.append(('normal', create_normalmap_material()))
+
+    saved_scene_layers = list(scene.layers)
+    saved_use_nodes = scene.use_nodes
+    saved_render_layers = [(layer, layer.use) for layer in scene.render.layers]
+    limb_objects = []
+    render_layers = []
+    nodes = []
+    # (render layer name, limb index, limb name, pass name)
+    outputs = []
+    try:
+        for layer, used in saved_render_layers:
+            layer.use = False
+        for limb_index, limb_group_name in enumerate(limb_group_names):
+            scene_layer = free_layers[limb_index]
+            scene.layers[scene_layer] = True
             mask_name = 'LimbMask_' + limb_group_name
-            if not mask_name in obj.modifiers:
-                continue
-            modifier = obj.modifiers[mask_name]
-            modifier.show_render = modifier.show_viewport = True
-            last_modifiers.append(modifier)
-        # render limb
-        target_directory = 'c:/tmp/'
-        if material is None:
-            filename = '%03d_%s.png' % (limb_index, limb_group_name)
-        else:
-            filename = '%03d_%s_%s.png' % (limb_index, limb_group_name, material.name)
+            for obj in objs:
+                if mask_name not in obj.modifiers:
+                    continue
+                limb_obj = obj.copy()
+                scene.objects.link(limb_obj)
+                limb_objects.append(limb_obj)
+                limb_obj.layers = [index == scene_layer for index in range(SCENE_LAYER_COUNT)]
+                for modifier in limb_obj.modifiers:
+                    if modifier.name.startswith('LimbMask_'):
+                        visible = modifier.name == mask_name
+                        modifier.show_render = modifier.show_viewport = visible
+            for pass_name, material in pass_materials:
+                filename = limb_filename(limb_index, limb_group_name, pass_name)
+                render_layer = scene.render.layers.new(os.path.splitext(filename)[0])
+                render_layer.layers = [
+                    index == scene_layer for index in range(SCENE_LAYER_COUNT)]
+                render_layer.material_override = material
+                render_layers.append(render_layer)
+                outputs.append((render_layer.name, limb_index, limb_group_name, pass_name))
+
+        scene.use_nodes = True
+        tree = scene.node_tree
+        output_node = tree.nodes.new('CompositorNodeOutputFile')
+        nodes.append(output_node)
+        output_node.base_path = target_directory
+        output_node.format.file_format = 'PNG'
+        output_node.format.color_mode = 'RGBA'
+        output_node.file_slots.clear()
+        for render_layer in render_layers:
+            layer_node = tree.nodes.new('CompositorNodeRLayers')
+            nodes.append(layer_node)
+            layer_node.scene = scene
+            layer_node.layer = render_layer.name
+            output_node.file_slots.new(render_layer.name)
+            tree.links.new(layer_node.outputs['Image'], output_node.inputs[render_layer.name])
+
+        _set_render_region(scene, region)
+        bpy.ops.render.render()
+    finally:
+        _set_render_region(scene, None)
+        for node in nodes:
+            scene.node_tree.nodes.remove(node)
+        scene.use_nodes = saved_use_nodes
+        for render_layer in render_layers:
+            scene.render.layers.remove(render_layer)
+        for layer, used in saved_render_layers:
+            layer.use = used
+        for limb_obj in limb_objects:
+            scene.objects.unlink(limb_obj)
+            bpy.data.objects.remove(limb_obj)
+        scene.layers = saved_scene_layers
+
+    entries = []
+    for output_name, limb_index, limb_group_name, pass_name in outputs:
+        # the File Output node appends the frame number to the filenames
+        filename = limb_filename(limb_index, limb_group_name, pass_name)
         filepath = os.path.join(target_directory, filename)
-        scene.render.filepath = filepath
-        bpy.ops.render.render(write_still=True)
+        if os.path.exists(filepath):
+            os.remove(filepath)
+        os.rename(
+            os.path.join(target_directory, '%s%04d.png' % (output_name, scene.frame_current)),
+            filepath)
+        entries.append(manifest_entry(
+            limb_index, limb_group_name, pass_name, filename, region))
+    write_manifest(scene, objs, target_directory, entries)
+
 
-    
 def chop(target_objects, group_threshold=0.5):
     """
     Interface for the chop_it operator.
@@ -288,26 +710,46 @@ def chop(target_objects, group_threshold=0.5):
     for obj in target_objects:
         pose_human(obj)
     # create a vertex group for each (sub object, limb)
-    for limb_group_name, limb_group in LIMB_CONFIG:
-        for root_object in target_objects:
-            for subobj in root_object.children:
-                if subobj.type.lower() == 'mesh':
-                    create_limb_groups(subobj, limb_group_name, limb_group, threshold=group_threshold)
+    for root_object in target_objects:
+        for subobj in root_object.children:
+            if subobj.type.lower() == 'mesh':
+                create_limb_groups(subobj, LIMB_CONFIG, threshold=group_threshold)
 
 
-def render(target_objects, flat_shaded=False, normal_maps=False):
+def render(target_objects, flat_shaded=False, normal_maps=False, background_jobs=0,
+           single_pass=False, crop=False, target_directory=RENDER_DIRECTORY):
     """
-    Interface for the render operator.
+    Interface for the render operator. With single_pass all the limbs are rendered
+    at once, and with background_jobs by that many background Blender processes
+    instead of in this session. With crop the images only cover their limbs.
+    The images and their manifest are written to target_directory.
     """
+    if not os.path.isdir(target_directory):
+        os.makedirs(target_directory)
     relevant_objs = []
     for root_object in target_objects:
         for subobj in root_object.children:
             if subobj.type.lower() == 'mesh':                        
                 relevant_objs.append(subobj) 
-    render_limbs(
-        relevant_objs, [name for name, groups in LIMB_CONFIG],
-        flat_shaded=flat_shaded, normal_maps=normal_maps
-    )
+    limb_group_names = [name for name, groups in LIMB_CONFIG]
+    if single_pass:
+        render_limbs_single_pass(
+            relevant_objs, limb_group_names,
+            flat_shaded=flat_shaded, normal_maps=normal_maps, crop=crop,
+            target_directory=target_directory
+        )
+    elif background_jobs > 0:
+        render_limbs_in_background(
+            relevant_objs, limb_group_names, background_jobs,
+            flat_shaded=flat_shaded, normal_maps=normal_maps, crop=crop,
+            target_directory=target_directory
+        )
+    else:
+        render_limbs(
+            relevant_objs, limb_group_names,
+            flat_shaded=flat_shaded, normal_maps=normal_maps, crop=crop,
+            target_directory=target_directory
+        )
 
 
 class ChopHumanOperator(bpy.types.Operator):
@@ -325,12 +767,32 @@ class RenderChoppedHumanOperator(bpy.types.Operator):
     bl_idname = 'chophuman.render_limbs'
     bl_label = 'Render'
 
-    output_path = bpy.props.StringProperty(subtype='FILE_PATH', name='Output path')
+    output_path = bpy.props.StringProperty(
+        subtype='DIR_PATH', name='Output path',
+        description='Directory to write the images and their manifest to')
     flat_shaded = bpy.props.BoolProperty(default=False, name='Flat shaded')
     normal_maps = bpy.props.BoolProperty(default=False, name='Normal maps')
+    background_jobs = bpy.props.IntProperty(
+        default=0, min=0, name='Background jobs',
+        description='Number of background Blender processes to render with (0 renders here)')
+    single_pass = bpy.props.BoolProperty(
+        default=False, name='Single render',
+        description='Render all the limbs in one render, with a render layer each')
+    crop = bpy.props.BoolProperty(
+        default=True, name='Crop to limbs',
+        description='Only render the part of the frame each limb covers')
 
     def execute(self, context):    
-        render(context.selected_objects, self.flat_shaded, self.normal_maps)
+        target_directory = RENDER_DIRECTORY
+        if self.output_path:
+            target_directory = bpy.path.abspath(self.output_path)
+        try:
+            render(
+                context.selected_objects, self.flat_shaded, self.normal_maps,
+                self.background_jobs, self.single_pass, self.crop, target_directory)
+        except (RuntimeError, OSError) as e:
+            self.report({'ERROR'}, str(e))
+            return {'CANCELLED'}
         return {'FINISHED'}
 
     def invoke(self, context, event):
@@ -351,3 +813,8 @@ class ChopHumanPanel(bpy.types.Panel):
         row.operator('chophuman.chop_it')
         row = layout.row()
         row.operator('chophuman.render_limbs')
+
+
+if __name__ == '__main__':
+    # started by render_limbs_in_background
+    _render_worker(sys.argv[sys.argv.index('--') + 1:])
@@ -0,0 +1,10 @@
+#!/usr/bin/env python
+"""
+Command line entry point; see chophumanfinisher.cli or run with --help.
+"""
+import sys
+from chophumanfinisher.cli import main
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+Headless versions of the operations the main window performs, for use by
+scripts and the command line (see chophumanfinisher.cli). Nothing here
+creates a QApplication or any widgets; skin images are loaded as QImages.
+"""
+import hashlib
+import os
+from collections import OrderedDict
+import numpy
+from PyQt4 import QtCore, QtGui
+from chophumanfinisher.exporters.scml import SCMLExporter
+from chophumanfinisher.importers.scml import SCMLImporter
+from chophumanfinisher.models.animation import Animation, Keyframe, EntityState
+from chophumanfinisher.models.retarget import RetargetLayer
+
+
+def importFile(path, useCache=True):
+    """Returns the (animationSets, skinFileMap) of an SCML file."""
+    importer = SCMLImporter()
+    importer.useCache = useCache
+    return importer.importFile(path)
+
+
+def retargetAnimationSet(animationSet, restName='rest'):
+    """
+    Applies the difference between the two keyframes of the rest animation
+    to every other keyframe of the set (see RetargetLayer). Returns False if
+    the set doesn't have a usable rest animation.
+    """
+    return RetargetLayer(animationSet, restName).update()
+
+
+def bakeAnimation(animation, step):
+    """
+    Returns a copy of the animation with a keyframe every `step` time units
+    (e.g. 1000 / fps), interpolated from the original keyframes.
+    """
+    baked = Animation()
+    baked.id = animation.id
+    baked.name = animation.name
+    baked.length = animation.length
+    baked.looping = animation.looping
+    if not animation.keyframes:
+        return baked
+    times = numpy.arange(0, max(animation.length, 1), step)
+    times = numpy.unique(times.astype(numpy.int64))
+    samples = animation.sample(times)
+    shape = animation.entityState.shape
+    for keyId, time in enumerate(times):
+        entityState = EntityState.fromChannels(
+            shape, samples.bones[keyId], samples.skins[keyId])
+        baked.addKeyframe(Keyframe(keyId, int(time), entityState))
+    return baked
+
+
+def bakeAnimationSet(animationSet, step):
+    for index, animation in enumerate(animationSet.animations):
+        baked = bakeAnimation(animation, step)
+        animationSet.animations[index] = baked
+        animationSet.animationByName[baked.name] = baked
+
+
+class SkinImage(object):
+    """
+    An unclipped skin image loaded from disk. It provides the parts of
+    MaskedSkinItem that the exporters use.
+    """
+    def __init__(self, filename):
+        self.filename = filename
+        self.image = QtGui.QImage(filename)
+        if self.image.isNull():
+            raise IOError('Unable to load skin image %s' % filename)
+        self._contentHash = None
+
+    def boundingRect(self):
+        return QtCore.QRectF(self.image.rect())
+
+    def getClipRect(self):
+        return self.boundingRect()
+
+    def getClippedImage(self):
+        return self.image, QtCore.QPointF()
+
+    def contentHash(self):
+        if self._contentHash is None:
+            image = self.image
+            digest = hashlib.sha1(b'%dx%d:' % (image.width(), image.height()))
+            digest.update(image.bits().asstring(image.byteCount()))
+            self._contentHash = digest.hexdigest()
+        return self._contentHash
+
+
+class SkinImages(object):
+    """The normal and diffuse images of a bone, like SkinGraphicsItem."""
+    def __init__(self):
+        self.normalItem = None
+        self.diffuseItem = None
+
+
+def loadSkinImages(animationSet, skinFileMap):
+    """
+    Returns a map of bone names to SkinImages for the skins of the set,
+    suitable for passing to an exporter in place of the main window's
+    skinItemMap.
+    """
+    skinItemMap = OrderedDict()
+    entityState = animationSet.entityState
+    if entityState is None:
+        return skinItemMap
+    for skin in entityState.skins:
+        fileData = skinFileMap.get(skin.id)
+        if fileData is None or skin.parent == -1:
+            continue
+        bone = entityState.bones[skin.parent]
+        skinImages = skinItemMap.setdefault(bone.name, SkinImages())
+        image = SkinImage(fileData['filename'])
+        if _isNormalMap(fileData['name']):
+            skinImages.normalItem = image
+        else:
+            skinImages.diffuseItem = image
+    return skinItemMap
+
+
+def _isNormalMap(name):
+    baseName = os.path.splitext(os.path.basename(name))[0]
+    return 'normal' in baseName or baseName.endswith('_n')
+
+
+def exportFile(animationSets, skinFileMap, outputFilepath, exporterClass=SCMLExporter):
+    """
+    Exports each AnimationSet along with its skin images. The first set is
+    written to outputFilepath and any others next to it with the name of
+    their entity appended. Returns the written paths.
+    """
+    basePath, extension = os.path.splitext(outputFilepath)
+    outputPaths = []
+    for index, animationSet in enumerate(animationSets):
+        if index == 0:
+            path = outputFilepath
+        else:
+            path = '%s_%s%s' % (basePath, animationSet.name or index, extension)
+        skinItemMap = loadSkinImages(animationSet, skinFileMap)
+        exporterClass().export(animationSet, skinItemMap, path)
+        outputPaths.append(path)
+    return outputPaths
@@ -0,0 +1,149 @@
+"""
+The chophuman command line: runs the import, retarget, export and bake
+steps over many SCML files without a display, e.g.
+
+    python src/chophuman.py retarget -j 8 -o out/ characters/*.scml
+
+Each input file is processed independently on a pool of worker processes
+and the time taken by each file is reported as it finishes.
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import time
+import traceback
+from chophumanfinisher import batch
+
+
+def commandImport(path, options):
+    animationSets, skinFileMap = batch.importFile(path, options.useCache)
+    animations = [a for animationSet in animationSets for a in animationSet.animations]
+    keyframeCount = sum(len(animation.keyframes) for animation in animations)
+    return '%d entities, %d animations, %d keyframes, %d skin files' % (
+        len(animationSets), len(animations), keyframeCount, len(skinFileMap))
+
+
+def commandRetarget(path, options):
+    animationSets, skinFileMap = batch.importFile(path, options.useCache)
+    for animationSet in animationSets:
+        if not batch.retargetAnimationSet(animationSet, options.restName):
+            raise ValueError('%s has no %r animation with two keyframes' % (
+                animationSet.name, options.restName))
+    return _export(path, animationSets, skinFileMap, options)
+
+
+def commandExport(path, options):
+    animationSets, skinFileMap = batch.importFile(path, options.useCache)
+    return _export(path, animationSets, skinFileMap, options)
+
+
+def commandBake(path, options):
+    animationSets, skinFileMap = batch.importFile(path, options.useCache)
+    for animationSet in animationSets:
+        batch.bakeAnimationSet(animationSet, 1000.0 / options.fps)
+    return _export(path, animationSets, skinFileMap, options)
+
+
+def _export(path, animationSets, skinFileMap, options):
+    outputFilepath = os.path.join(options.outputPath, os.path.basename(path))
+    if os.path.abspath(outputFilepath) == os.path.abspath(path):
+        raise ValueError('refusing to overwrite the input file')
+    outputPaths = batch.exportFile(animationSets, skinFileMap, outputFilepath)
+    return 'wrote %s' % ', '.join(outputPaths)
+
+
+COMMANDS = {
+    'import': commandImport,
+    'retarget': commandRetarget,
+    'export': commandExport,
+    'bake': commandBake,
+}
+
+
+def runTask(task):
+    """
+    Runs function(path, options) for a (function, path, options) task and
+    returns (path, seconds, ok, message). This is called in the worker
+    processes so it never raises.
+    """
+    function, path, options = task
+    startTime = time.time()
+    try:
+        message = function(path, options)
+        ok = True
+    except Exception:
+        message = traceback.format_exc().rstrip()
+        ok = False
+    return path, time.time() - startTime, ok, message
+
+
+def runTasks(label, tasks, jobs, initializer=None, initargs=()):
+    """
+    Runs the tasks on a pool of `jobs` processes, printing the outcome and
+    time of each as it finishes. initializer(*initargs) is called once in
+    each process before any tasks. Returns the number of failed tasks.
+    """
+    jobs = max(1, min(jobs, len(tasks)))
+    startTime = time.time()
+    failures = 0
+    if jobs == 1:
+        if initializer is not None:
+            initializer(*initargs)
+        results = (runTask(task) for task in tasks)
+        pool = None
+    else:
+        pool = multiprocessing.Pool(jobs, initializer, initargs)
+        results = pool.imap_unordered(runTask, tasks)
+    try:
+        for path, seconds, ok, message in results:
+            if not ok:
+                failures += 1
+            print('%8.3fs %s %s: %s' % (seconds, 'ok  ' if ok else 'FAIL', path, message))
+            sys.stdout.flush()
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print('%s: %d files, %d failed in %.3fs using %d processes' % (
+        label, len(tasks), failures, time.time() - startTime, jobs))
+    return failures
+
+
+def makeParser():
+    parser = argparse.ArgumentParser(
+        prog='chophuman', description='Batch processing of ChopHuman SCML files.')
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument('files', nargs='+', metavar='FILE', help='SCML files to process')
+    common.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='number of worker processes (default: one per cpu)')
+    common.add_argument('--no-cache', dest='useCache', action='store_false',
+        help="don't read or write the .chcache files of the inputs")
+    output = argparse.ArgumentParser(add_help=False)
+    output.add_argument('-o', '--output', dest='outputPath', required=True,
+        help='directory to write the exported files to')
+
+    subparsers = parser.add_subparsers(dest='command')
+    subparsers.add_parser('import', parents=[common],
+        help='import the files, reporting what they contain and caching them')
+    retarget = subparsers.add_parser('retarget', parents=[common, output],
+        help='apply the rest pose correction to every animation and export')
+    retarget.add_argument('--rest', dest='restName', default='rest',
+        help='name of the two keyframe rest animation (default: rest)')
+    subparsers.add_parser('export', parents=[common, output],
+        help='import the files and export them again')
+    bake = subparsers.add_parser('bake', parents=[common, output],
+        help='export with a keyframe on every frame')
+    bake.add_argument('--fps', type=float, default=30.0,
+        help='frames per second to bake at (default: 30)')
+    return parser
+
+
+def main(argv=None):
+    options = makeParser().parse_args(argv)
+    if getattr(options, 'outputPath', None) and not os.path.isdir(options.outputPath):
+        os.makedirs(options.outputPath)
+    function = COMMANDS[options.command]
+    tasks = [(function, path, options) for path in options.files]
+    failures = runTasks(options.command, tasks, options.jobs)
+    return 1 if failures else 0
@@ -1,11 +1,17 @@
 import math
 import os
+import re
 from PyQt4 import QtCore, QtGui
 from chophumanfinisher.exporters.scml import SCMLExporter
+from chophumanfinisher.importers.rendermanifest import RENDER_DIRECTORY, RenderManifest
 from chophumanfinisher.importers.scml import SCMLImporter
+from chophumanfinisher.models import pose
 from chophumanfinisher.models.animation import EntityState
+from chophumanfinisher.models.playbackcache import PlaybackCache
+from chophumanfinisher.models.retarget import RetargetLayer
 from chophumanfinisher.models.skeleton import normalizeAngle 
 from chophumanfinisher.ui.ui_mainwindow import Ui_ChopHumanMainWindow
+from .playback import FrameStats, ItemTransforms, PlaybackClock
 from .scenes import ChopHumanGraphicsScene
 from .widgets import BoneGraphicsItem, MaskedSkinItem, SkinGraphicsItem
 from .window_delegates import (
@@ -13,12 +19,20 @@ from .window_delegates import (
 )
 
 
+# the bone name in the filenames of skin images, see _findBoneByName
+IMAGE_NAME_PATTERN = re.compile(r'^(?:\d+_)?(?:chop_)?(?P<bone>.+?)(?:_normal_material|_[dn])?$')
+
+
 class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
     """
     This does practically everything; what a *great* class!
     """
     PLAYBACK_TIMER_INTERVAL = 10 # ms
     changesCreateNewKeyframe = True 
+    # play back from baked frames instead of interpolating every frame
+    usePlaybackCache = True
+    # where images were last loaded from
+    renderDirectory = RENDER_DIRECTORY
     # sends the current state and its flattened version
     entityStateChanged = QtCore.pyqtSignal(EntityState, EntityState)
     
@@ -27,6 +41,7 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         self.setupUi(self)
 
         self.animationSet = None
+        self.retargetLayer = None
         self.currentAnimation = None
         self.entityState = None
         self.animationItemMap = {}
@@ -41,6 +56,16 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         self.sceneGraphicsView.setScene(self.scene)
 
         self.playbackTimer = QtCore.QTimer(self)
+        self.frameStats = FrameStats()
+        self.playbackCache = PlaybackCache()
+        self.playbackClock = PlaybackClock(1000.0 / self.PLAYBACK_TIMER_INTERVAL)
+        self._updatePending = False
+        self.frameTimeLabel = QtGui.QLabel(self.sceneGraphicsView)
+        self.frameTimeLabel.setStyleSheet(
+            'background: rgba(0, 0, 0, 128); color: white; padding: 2px;')
+        self.frameTimeLabel.move(8, 8)
+        self.frameTimeLabel.hide()
+        self._itemTransforms = None
 
         self._wireEvents()
         self.reset()
@@ -68,22 +93,7 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         def onGoToEndOfPlayback():
             self.playbackSlider.setValue(self.playbackSlider.maximum())
         self.butTogglePlay.clicked.connect(self.onTogglePlayback)
-        @self.playbackTimer.timeout.connect
-        def onPlaybackTick():
-            if not self.currentAnimation:
-                return
-            currentSliderVal = self.playbackSlider.value()
-            playbackInterval = self.playbackTimer.interval()
-            delta = playbackInterval / float(self.currentAnimation.length)
-            maxVal = self.playbackSlider.maximum()
-            newVal = currentSliderVal + delta * maxVal
-            if newVal >= maxVal:
-                if self.currentAnimation.looping: 
-                    newVal -= maxVal
-                else:
-                    newVal = maxVal
-                    self.butTogglePlay.click()
-            self.playbackSlider.setValue(newVal)
+        self.playbackTimer.timeout.connect(self.onPlaybackTick)
         self.entityStateChanged.connect(self.updateModelItems)
         @self.chkHighlightSelected.stateChanged.connect
         def onToggleHighlightSelected(state):
@@ -91,12 +101,14 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         @self.actionFreezeSkins.triggered.connect
         def onToggleFreezeSkin(val):
             if not self.actionFreezeSkins.isChecked():
+                self._invalidateItemTransforms()
                 self.copySkinTransforms()
         @self.butLooping.clicked.connect
         def onToggleLooping(val):
             if not self.currentAnimation:
                 return
             self.currentAnimation.looping = bool(self.butLooping.isChecked())
+            self.playbackCache.invalidate(self.currentAnimation)
         @self.butNewAnimation.clicked.connect
         def onNewAnimation():
             if not self.animationSet:
@@ -135,6 +147,7 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
             for item in selectedItems:
                 animation = self.animationItemMap[item]
                 self.animationSet.removeAnimation(animation)
+                self.playbackCache.invalidate(animation)
                 self.animationListWidget.takeItem(self.animationListWidget.row(item))
         @self.butRetargetAnimation.clicked.connect
         def onRetargetAnimation():
@@ -175,15 +188,23 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
 
     @property
     def frameTime(self):
+        """
+        The current frame. self.t is a fraction of the animation's length,
+        so it is rounded: truncating would turn e.g. 29 / 100.0 * 100 into
+        frame 28.
+        """
         if not self.currentAnimation:
             return 0
-        return int(self.t * self.currentAnimation.length)
+        return int(round(self.t * self.currentAnimation.length))
 
     def onTogglePlayback(self):
         isPlaying = self.butTogglePlay.isChecked()
         if isPlaying:
             if self.currentAnimation:
                 label = 'Stop' 
+                self.frameStats.clear()
+                self.playbackClock.start(self.playbackSlider.value())
+                self.frameTimeLabel.show()
                 self.playbackTimer.start(self.PLAYBACK_TIMER_INTERVAL)
             else:
                 label = 'Play'
@@ -191,8 +212,38 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         else:
             label = 'Play'
             self.playbackTimer.stop()
+            self.frameTimeLabel.hide()
         #self.butTogglePlay.setText(label)
     
+    def onPlaybackTick(self):
+        """
+        Shows the frame for the time elapsed since playback started. Frames
+        are skipped when drawing falls behind, and nothing is redrawn if the
+        frame hasn't changed since the last tick.
+        """
+        animation = self.currentAnimation
+        if not animation:
+            return
+        frameTime = int(self.playbackClock.animationTime())
+        lastFrame = self.playbackSlider.maximum()
+        finished = False
+        if frameTime > lastFrame:
+            if animation.looping:
+                frameTime %= lastFrame + 1
+            else:
+                frameTime = lastFrame
+                finished = True
+        if frameTime != self.playbackSlider.value():
+            # the slider would otherwise trigger a second update
+            self.playbackSlider.blockSignals(True)
+            self.playbackSlider.setValue(frameTime)
+            self.playbackSlider.blockSignals(False)
+            self.t = frameTime / float(animation.length)
+            self.updateAnimationState()
+            self.playbackClock.frameDone()
+        if finished:
+            self.butTogglePlay.click()
+
     def _createDelegates(self):
         self._delegate = None
         DELEGATE_CLASSES = (
@@ -223,6 +274,7 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         
     def _createExporters(self):
         EXPORTER_CLASSES = (SCMLExporter,)
+        self._exporters = {}
         self.exporterActionGroup = QtGui.QActionGroup(self)
         for exporterClass in EXPORTER_CLASSES:
             action = QtGui.QAction(exporterClass.verboseName(), None)
@@ -252,7 +304,10 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         if not filename:
             return
         filename = unicode(filename)
-        exporter = exporterClass()
+        # exporters keep what they encoded for the next export
+        exporter = self._exporters.get(exporterClass)
+        if exporter is None:
+            exporter = self._exporters[exporterClass] = exporterClass()
         exporter.export(self.animationSet, self.skinItemMap, filename)
     
     def onImport(self, importerClass):
@@ -263,7 +318,7 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
             return        
         filename = unicode(filename)
         importer = importerClass()
-        animationSets, skinFileMap = importer.importFile(filename)
+        animationSets, skinFileMap = importer.importFile(filename, lazy=True)
         # TODO: only clear the animation set if the imported animations are of different shapes.
         # TODO: otherwise, add them to the current animationSet
         
@@ -274,11 +329,11 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         for animation in self.animationSet.animations:
             animationListItem = self._makeAnimationListItem(animation)
             self.animationListWidget.addItem(animationListItem)
-        # create the requisite bone items 
+        # create the requisite bone items, parents before their children
         entityState = self.animationSet.entityState
-        currentRoot = None
         boneTreeItemMap = self.boneTreeItemMap
-        for bone in entityState.bones:
+        for boneId in entityState.topology().order:
+            bone = entityState.bones[boneId]
             boneItem = BoneGraphicsItem()
             boneItem.bone = bone.clone()
             boneItem.boneChanged.connect(self.onBoneChanged)
@@ -291,13 +346,7 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
                 parentItem = boneTreeItemMap[parentBone.name]
                 parentItem.addChild(thisBoneTreeItem)
             else:
-                if currentRoot:
-                    self.skeletonTreeWidget.addTopLevelItem(currentRoot)
-                    currentRoot = None
-            if not currentRoot:
-                currentRoot = thisBoneTreeItem
-        if currentRoot:
-            self.skeletonTreeWidget.addTopLevelItem(currentRoot)
+                self.skeletonTreeWidget.addTopLevelItem(thisBoneTreeItem)
 
         self.skeletonTreeWidget.expandAll()
         self.animationListWidget.setCurrentRow(0) # set up us the bones
@@ -330,8 +379,11 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         self.selectedBoneItem = None
 
         self.skeletonTreeWidget.clear()
+        self._itemTransforms = None
         
         self.animationSets = None
+        self.retargetLayer = None
+        self.playbackCache.invalidate()
         self.animationListWidget.clear()
         self.t = 0.0
         self.currentAnimation = None
@@ -357,52 +409,133 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
             QtGui.QMessageBox.information(self, 'Sorry, this menu item should be lower.', 'You will need to load some animations first.')
             return
         filenames, _ = QtGui.QFileDialog.getOpenFileNamesAndFilter(
-            self, 'Choose images', 'c:/tmp/', 'Image files (*.png *.jpg *.jpeg *.gif *.tga)'
+            self, 'Choose images', self.renderDirectory,
+            'Image files (*.png *.jpg *.jpeg *.gif *.tga);;Render manifests (*.json)'
         )
         if not filenames:
             return
         self.pushCursor(QtCore.Qt.WaitCursor)
-        self.loadImages(filenames, positionFromImage=True)
+        filenames = [unicode(filename) for filename in filenames]
+        self.renderDirectory = os.path.dirname(filenames[0])
+        manifestFilenames = [filename for filename in filenames if filename.lower().endswith('.json')]
+        for filename in manifestFilenames:
+            self.loadRenderManifest(filename, positionFromImage=True)
+        imageFilenames = [filename for filename in filenames if filename not in manifestFilenames]
+        if imageFilenames:
+            self.loadImages(imageFilenames, positionFromImage=True)
         self.copySkinTransforms()
         self.popCursor()
 
     def loadImages(self, filenames, positionFromImage=False):
+        manifests = {}
         for filename in filenames:
             filename = unicode(filename)
-            pixmap = QtGui.QPixmap()
-            pixmap.load(filename)
-            fullWidth = pixmap.width()
-            fullHeight = pixmap.height()
-            pixmapItem = MaskedSkinItem(pixmap)
-            # cut out all the wasted space and position what remains
-            opaqueArea = pixmapItem.opaqueArea()
-            clippedPixmap = pixmap.copy(opaqueArea.boundingRect().toRect())
-            clippedPixmapItem = MaskedSkinItem(clippedPixmap)
-            pos = opaqueArea.boundingRect().topLeft()
-            pixmapItem = clippedPixmapItem
-            skinFileName = os.path.split(filename)[-1]
-            skinBaseName = skinFileName.replace('_normal_material', '')
-            bone = self._findBoneByName(skinBaseName)
-            skin = self._findSkinByBoneName(skinBaseName)
-            if not skin:
-                print('no skin for ' + skinBaseName)
-            if not bone:
-                print('no bone for ' + skinBaseName)
-            skinItem = self.skinItemMap.get(bone.name, None)
-            if not skinItem:
-                skinItem = SkinGraphicsItem()
-                skinItem.setZValue(skin.zIndex)
-                self.skinItemMap[bone.name] = skinItem
-                self.scene.addItem(skinItem)
-                positionFromImage = True
-            if positionFromImage:
-                offset = QtCore.QPointF(0.5 * fullWidth, fullHeight)
-                pos -= offset
-                skinItem.setPos(pos)
-            if 'normal' in skinFileName:
-                skinItem.normalItem = pixmapItem
+            # images rendered by the Blender add-on are described by a manifest
+            # next to them
+            directory = os.path.dirname(filename)
+            if directory not in manifests:
+                manifests[directory] = RenderManifest.find(directory)
+            manifest = manifests[directory]
+            rendered = manifest.findImage(filename) if manifest else None
+            if rendered:
+                self._loadRenderedImage(manifest, rendered, positionFromImage)
+            else:
+                self._loadImage(filename, positionFromImage)
+        self._onImagesLoaded()
+
+    def loadRenderManifest(self, path, positionFromImage=False):
+        """Loads all the images listed in the manifest at path."""
+        manifest = RenderManifest.read(unicode(path))
+        if not manifest:
+            print('could not read the manifest ' + path)
+            return
+        for rendered in manifest.images:
+            self._loadRenderedImage(manifest, rendered, positionFromImage)
+        self._onImagesLoaded()
+
+    def _loadImage(self, filename, positionFromImage):
+        pixmap = QtGui.QPixmap()
+        pixmap.load(filename)
+        pixmapItem = MaskedSkinItem(pixmap)
+        # cut out all the wasted space and position what remains
+        opaqueArea = pixmapItem.opaqueArea()
+        clippedPixmap = pixmap.copy(opaqueArea.boundingRect().toRect())
+        pixmapItem = MaskedSkinItem(clippedPixmap)
+        # the bottom center of the image is the origin of the scene
+        pos = opaqueArea.boundingRect().topLeft() - QtCore.QPointF(
+            0.5 * pixmap.width(), pixmap.height())
+        skinFileName = os.path.split(filename)[-1]
+        skinBaseName = skinFileName.replace('_normal_material', '')
+        bone = self._findBoneByName(skinBaseName)
+        self._addSkinImage(
+            bone, pixmapItem, pos, 'normal' in skinFileName, positionFromImage, skinBaseName)
+
+    def _loadRenderedImage(self, manifest, rendered, positionFromImage):
+        bone = self.entityState.findBone(rendered.boneName) if self.entityState else None
+        skinItem = self.skinItemMap.get(rendered.boneName, None)
+        if skinItem:
+            if rendered.isNormalMap:
+                currentItem = skinItem.normalItem
             else:
-                skinItem.diffuseItem = pixmapItem
+                currentItem = skinItem.diffuseItem
+            if getattr(currentItem, 'renderHash', None) == rendered.contentHash:
+                # already loaded, keep how it was trimmed and placed
+                return
+        data = rendered.read()
+        if data is None:
+            # the offset and pivot may not fit the image anymore
+            print('%s changed since it was rendered' % rendered.filename)
+            self._loadImage(rendered.filename, positionFromImage)
+            return
+        pixmap = QtGui.QPixmap()
+        pixmap.loadFromData(data)
+        pos = QtCore.QPointF(*rendered.offset)
+        if not manifest.isCropped(rendered):
+            # the renderer left the empty space around the limb
+            opaqueArea = MaskedSkinItem(pixmap).opaqueArea().boundingRect()
+            pixmap = pixmap.copy(opaqueArea.toRect())
+            pos += opaqueArea.topLeft()
+        flatBone = self.flatEntityState.findBone(bone.name) if bone else None
+        if rendered.pivot and flatBone:
+            # put the pivot of the rendered limb on its bone
+            transform = flatBone.transform
+            pos += QtCore.QPointF(transform.x, transform.y) - QtCore.QPointF(*rendered.pivot)
+        else:
+            fullWidth, fullHeight = manifest.frameSize
+            pos -= QtCore.QPointF(0.5 * fullWidth, fullHeight)
+        pixmapItem = MaskedSkinItem(pixmap)
+        pixmapItem.renderHash = rendered.contentHash
+        self._addSkinImage(
+            bone, pixmapItem, pos, rendered.isNormalMap, positionFromImage, rendered.boneName)
+
+    def _addSkinImage(self, bone, pixmapItem, pos, isNormalMap, positionFromImage, name):
+        """
+        Puts an image of a bone's skin into the scene. pos is where its top
+        left corner goes in the scene when it is positioned from the image.
+        """
+        if not bone:
+            print('no bone for ' + name)
+            return
+        skins = self.entityState.findSkinsOfBone(bone)
+        if not skins:
+            print('no skin for ' + name)
+            return
+        skinItem = self.skinItemMap.get(bone.name, None)
+        if not skinItem:
+            skinItem = SkinGraphicsItem()
+            skinItem.setZValue(skins[0].zIndex)
+            self.skinItemMap[bone.name] = skinItem
+            self.scene.addItem(skinItem)
+            positionFromImage = True
+        if positionFromImage:
+            skinItem.setPos(pos)
+        if isNormalMap:
+            skinItem.normalItem = pixmapItem
+        else:
+            skinItem.diffuseItem = pixmapItem
+
+    def _onImagesLoaded(self):
+        self._itemTransforms = None
         # move bones to the front
         for item in self.boneItemMap.values():
             item.setZValue(1000.0)
@@ -427,20 +560,19 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
             cursor = self._cursorState.pop()
             self.setCursor(cursor)
 
-    def _findSkinByBoneName(self, name):
-        if not self.entityState:
-            return
-        for skin in self.entityState.skins:
-            bone = self.entityState.bones[skin.parent]
-            if bone.name in name:
-                return skin
-        return None
-
     def _findBoneByName(self, name):
+        """
+        Finds the bone an image filename is named after: the renders of the
+        Blender add-on like 003_chop_left_arm_normal_material.png and the
+        exported images like left_arm_d.png.
+        """
         if not self.entityState:
-            return
-        for bone in self.entityState.bones:
-            if bone.name in name:
+            return None
+        stem = os.path.splitext(os.path.basename(name))[0]
+        match = IMAGE_NAME_PATTERN.match(stem)
+        for boneName in (match.group('bone'), stem):
+            bone = self.entityState.findBone(boneName)
+            if bone:
                 return bone
         return None
 
@@ -463,6 +595,7 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         if not self.currentAnimation:
             return
         self.currentAnimation.length = int(value)
+        self.playbackCache.invalidate(self.currentAnimation)
         self.playbackSlider.setMaximum(int(value) - 1)
         self.onAnimationTimeChanged(self.playbackSlider.value())
 
@@ -470,39 +603,96 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         if not self.currentAnimation:
             return
         self.t = newT / float(self.currentAnimation.length)
+        if self.playbackTimer.isActive():
+            # the slider was moved during playback, carry on from there
+            self.playbackClock.start(newT)
+        self._requestAnimationStateUpdate()
+
+    def _requestAnimationStateUpdate(self):
+        """
+        Updates the animation state once control returns to the event loop,
+        so that the many value changes of a dragged slider only cost one.
+        """
+        if not self._updatePending:
+            self._updatePending = True
+            QtCore.QTimer.singleShot(0, self._onPendingUpdate)
+
+    def _onPendingUpdate(self):
+        self._updatePending = False
         self.updateAnimationState()
 
     def updateAnimationState(self):
         if not self.currentAnimation:
             self.spinAnimationLength.setValue(0)
             return
+        frameTimer = QtCore.QElapsedTimer()
+        frameTimer.start()
         animation = self.currentAnimation
-        frameT = int(self.t * animation.length)
+        frameT = self.frameTime
         self.labelCurrentFrame.setText(str(frameT + 1))
-        animation.updateEntityState(self.entityState, frameT)
-        self.entityState.flatten(self.flatEntityState)
+        if not (self.usePlaybackCache and self.playbackCache.updateEntityState(
+                animation, frameT, self.entityState, self.flatEntityState)):
+            animation.updateEntityState(self.entityState, frameT)
+            self.entityState.flatten(self.flatEntityState)
         self.entityStateChanged.emit(self.entityState, self.flatEntityState)
+        self.frameStats.add(frameTimer.nsecsElapsed() * 1e-6)
+        if self.frameTimeLabel.isVisible():
+            self.frameTimeLabel.setText('%s\n%s' % (
+                self.frameStats.summary(), self.playbackClock.summary()))
+            self.frameTimeLabel.adjustSize()
     
     def updateModelItems(self, entityState, flatEntityState):
-        entityState = flatEntityState
-        for bone in entityState.bones:
-            boneItem = self.boneItemMap.get(bone.name, None)
-            if not boneItem:
-                continue
-            boneItem.setRotation(bone.transform.angle)
-            boneItem.setPos(bone.transform.x, bone.transform.y)
+        boneTransforms, skinTransforms = self._getItemTransforms(flatEntityState)
+        boneTransforms.apply(flatEntityState.boneChannels)
         if not self.actionFreezeSkins.isChecked():
-            for skin in entityState.skins:
-                bone = entityState.bones[skin.parent]
-                skinItem = self.skinItemMap.get(bone.name, None)
+            skinTransforms.apply(flatEntityState.skinChannels)
+
+    def _getItemTransforms(self, entityState):
+        """
+        Returns ItemTransforms lining the bone and skin items up with the
+        bones and skins of the state. They are only rebuilt when the rig or
+        the items change.
+        """
+        topology = entityState.topology()
+        if self._itemTransforms is None or self._itemTransforms[0] is not topology:
+            boneShape, skinShape = entityState.shape
+            boneRows, boneItems = [], []
+            for boneId, boneMeta in enumerate(boneShape):
+                boneItem = boneMeta and self.boneItemMap.get(boneMeta[0], None)
+                if boneItem:
+                    boneRows.append(boneId)
+                    boneItems.append(boneItem)
+            # several skins may share a bone's item; the last one places it
+            skinRowByItem = {}
+            skinItems = []
+            for skinId, (_, parent) in enumerate(skinShape):
+                if parent < 0 or boneShape[parent] is None:
+                    continue
+                skinItem = self.skinItemMap.get(boneShape[parent][0], None)
                 if not skinItem:
                     continue
-                skinItem.setRotation(skin.transform.angle)
-                skinItem.setPos(skin.transform.x, skin.transform.y)
+                if skinItem not in skinRowByItem:
+                    skinItems.append(skinItem)
+                skinRowByItem[skinItem] = skinId
+            self._itemTransforms = (
+                topology,
+                ItemTransforms(boneRows, boneItems, pose.TRANSFORM_CHANNELS),
+                ItemTransforms(
+                    [skinRowByItem[item] for item in skinItems], skinItems,
+                    pose.SKIN_CHANNELS)
+            )
+        return self._itemTransforms[1:]
+
+    def _invalidateItemTransforms(self):
+        """Call when items were moved other than by updateModelItems."""
+        if self._itemTransforms is not None:
+            for itemTransforms in self._itemTransforms[1:]:
+                itemTransforms.invalidate()
 
     def onBoneChanged(self):
         if not self.currentAnimation:
             return
+        self._invalidateItemTransforms()
         boneItem = self.selectedBoneItem
         bone = boneItem.bone
         pos = boneItem.pos()
@@ -515,18 +705,26 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         bone.transform.x = pos.x()
         bone.transform.y = pos.y()
         bone.transform.angle = rotation
-        frameTime = int(self.t * self.currentAnimation.length)
+        frameTime = self.frameTime
         keyframe = self.currentAnimation.getKeyframeAt(frameTime)
         if self.changesCreateNewKeyframe and keyframe.time != frameTime:
             newKeyframe = self._createKeyframeFromStateNow()
         else:
             keyframe.entityState.boneByName[bone.name].copy(bone)
+            self.currentAnimation.keyframeChanged(keyframe)
+            if keyframe.time == frameTime:
+                # the current pose is the keyframe's, so only the edited bone
+                # and its descendants are flattened again
+                self.entityState.boneByName[bone.name].copy(bone)
+                self.entityState.flatten(self.flatEntityState)
+                self.entityStateChanged.emit(self.entityState, self.flatEntityState)
+                return
         self.updateAnimationState()
     
     def _createKeyframeFromStateNow(self):
         if not self.currentAnimation:
             return
-        frameTime = int(self.t * self.currentAnimation.length)
+        frameTime = self.frameTime
         keyframe = self.currentAnimation.getKeyframeAt(frameTime)
         # does a keyframe already exist for this frame?
         if keyframe.time == frameTime:
@@ -564,6 +762,7 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
             skin.transform.x = pos.x()
             skin.transform.y = pos.y()
             skin.transform.angle = skinItem.rotation() - boneItem.rotation()
+        self.currentAnimation.keyframeChanged(keyframe)
         self.updateAnimationState()
 
     def retargetAnimation(self):
@@ -576,23 +775,12 @@ class ChopHumanMainWindow(QtGui.QMainWindow, Ui_ChopHumanMainWindow):
         # TODO: if any of this fails, show a dialog that has some instructions
         if not self.animationSet:
             return
-        restAnimation = self.animationSet.animationByName.get('rest', None)
-        if not restAnimation:
+        layer = self.retargetLayer
+        if layer is None or layer.animationSet is not self.animationSet:
+            layer = self.retargetLayer = RetargetLayer(self.animationSet, 'rest')
+        if not layer.update():
             return
-        # compare the original pose with the target (new) pose
-        originalKeyframe = restAnimation.keyframes[0]
-        targetKeyframe = restAnimation.keyframes[1]
-        originalEntityState = originalKeyframe.entityState
-        targetEntityState = targetKeyframe.entityState
-        diffEntityState = targetEntityState.clone()
-        diffEntityState.difference(originalEntityState, targetEntityState, True)
-        for animation in self.animationSet.animations:
-            if animation.name == 'rest':
-                animation.keyframes[0].entityState.combineSelf(diffEntityState, True)
-                continue
-            for keyframe in animation.keyframes:
-                keyframe.entityState.combineSelf(diffEntityState, True)
-
+        self.playbackCache.invalidate()
         self.updateAnimationState()
         QtGui.QMessageBox.information(self, 'Retargeting complete', 'Retargeting is complete.')
 
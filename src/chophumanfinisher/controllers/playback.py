@@ -0,0 +1,117 @@
+"""
+Helpers for the main window's animation playback.
+"""
+from collections import deque
+import numpy
+from PyQt4 import QtCore
+from chophumanfinisher.models import pose
+
+
+class ItemTransforms(object):
+    """
+    Moves graphics items to rows of world channels. The items are lined up
+    with their rows once, and items whose position and rotation didn't
+    change since they were last set are skipped.
+    """
+    CHANNELS = (pose.X, pose.Y, pose.ANGLE)
+
+    def __init__(self, rows, items, channelCount):
+        self.items = list(items)
+        rows = numpy.asarray(rows, dtype=numpy.intp).reshape(-1, 1)
+        # indices of (x, y, angle) of each row in the flattened channels
+        self._flatIndex = rows * channelCount + numpy.array(self.CHANNELS)
+        self._values = numpy.empty(self._flatIndex.shape)
+        self._shown = numpy.empty(self._flatIndex.shape)
+        self._changed = numpy.empty(self._flatIndex.shape, dtype=bool)
+        self.invalidate()
+
+    def invalidate(self):
+        """Makes the next apply set every item, e.g. after one was moved."""
+        self._shown.fill(numpy.nan)
+
+    def apply(self, channels):
+        """Returns the number of items that were moved."""
+        if not self.items:
+            return 0
+        values = numpy.take(channels.reshape(-1), self._flatIndex, out=self._values)
+        numpy.not_equal(values, self._shown, out=self._changed)
+        changed = numpy.flatnonzero(self._changed.any(axis=1))
+        items = self.items
+        for index in changed:
+            x, y, angle = values[index]
+            item = items[index]
+            item.setRotation(angle)
+            item.setPos(x, y)
+        self._shown[changed] = values[changed]
+        return len(changed)
+
+
+class FrameStats(object):
+    """Keeps the durations of the most recent frames."""
+    def __init__(self, size=120):
+        self.frameTimes = deque(maxlen=size)
+
+    def add(self, milliseconds):
+        self.frameTimes.append(milliseconds)
+
+    def clear(self):
+        self.frameTimes.clear()
+
+    @property
+    def average(self):
+        if not self.frameTimes:
+            return 0.0
+        return sum(self.frameTimes) / len(self.frameTimes)
+
+    @property
+    def worst(self):
+        return max(self.frameTimes) if self.frameTimes else 0.0
+
+    def summary(self):
+        return 'frame %.1f ms (worst %.1f ms)' % (self.average, self.worst)
+
+
+class PlaybackClock(object):
+    """
+    Maps the time elapsed on a monotonic clock to an animation time, so
+    playback keeps real time however long each frame takes to draw; the
+    frames there was no time for are skipped. Also measures the achieved
+    frame rate against targetFps, the rate of the playback timer.
+    """
+    def __init__(self, targetFps, window=60):
+        self.targetFps = targetFps
+        self._timer = QtCore.QElapsedTimer()
+        self._startTime = 0
+        self._presentedFrames = 0
+        self._frameTimes = deque(maxlen=window)
+
+    def start(self, animationTime):
+        self._timer.start()
+        self._startTime = animationTime
+        self._presentedFrames = 0
+        self._frameTimes.clear()
+
+    def animationTime(self):
+        return self._startTime + self._timer.elapsed()
+
+    def frameDone(self):
+        self._presentedFrames += 1
+        self._frameTimes.append(self._timer.elapsed())
+
+    @property
+    def fps(self):
+        """The frame rate over the last few frames."""
+        times = self._frameTimes
+        if len(times) < 2 or times[-1] == times[0]:
+            return 0.0
+        return 1000.0 * (len(times) - 1) / (times[-1] - times[0])
+
+    @property
+    def droppedFrames(self):
+        """Ticks of the playback timer there was no time to draw."""
+        expected = int(self._timer.elapsed() * self.targetFps / 1000.0)
+        return max(0, expected - self._presentedFrames)
+
+    def summary(self):
+        return '%.0f of %.0f fps, %d dropped' % (
+            self.fps, self.targetFps, self.droppedFrames)
@@ -1,3 +1,4 @@
+import hashlib
 import math
 from PyQt4 import QtCore, QtGui
 from chophumanfinisher.models.skeleton import Bone, Skin
@@ -97,22 +98,101 @@ class LimbGraphicsItem(QtGui.QGraphicsItem):
         return skinBounds.united(boneBounds)
 
 
+class SkinMask(object):
+    """
+    The trimmed area of a limb's skins, as an alpha bitmap in the coordinates
+    of the skin images: opaque pixels are shown and transparent ones are
+    trimmed. Brush strokes are stamped into the bitmap, so a stroke costs the
+    same however much has been trimmed before it. A path is only traced from
+    the bitmap when one is asked for, e.g. when exporting.
+    """
+    def __init__(self, image):
+        self.image = image
+        # bumped on every change, for the caches below
+        self.revision = 0
+        self._path = None
+        self._pathRevision = None
+        self._hash = None
+        self._hashRevision = None
+
+    @classmethod
+    def fromPixmap(cls, pixmap):
+        """A mask showing the opaque pixels of pixmap, like its opaqueArea."""
+        image = QtGui.QImage(pixmap.size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+        image.fill(0)
+        painter = QtGui.QPainter()
+        if painter.begin(image):
+            if pixmap.hasAlpha():
+                painter.setClipRegion(QtGui.QRegion(pixmap.mask()))
+            painter.fillRect(image.rect(), QtCore.Qt.black)
+            painter.end()
+        else:
+            print('Failed to start painting SkinMask')
+        return cls(image)
+
+    def stamp(self, center, radiusX, radiusY, reveal=False):
+        """
+        Trims an ellipse, or shows it again if reveal is set. Returns the
+        QRect of the pixels which may have changed.
+        """
+        ellipse = QtCore.QRectF(
+            center.x() - radiusX, center.y() - radiusY, 2 * radiusX, 2 * radiusY)
+        dirtyRect = ellipse.toAlignedRect().intersected(self.image.rect())
+        if dirtyRect.isEmpty():
+            return dirtyRect
+        painter = QtGui.QPainter()
+        if not painter.begin(self.image):
+            print('Failed to start painting SkinMask')
+            return QtCore.QRect()
+        if reveal:
+            painter.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+        else:
+            painter.setCompositionMode(QtGui.QPainter.CompositionMode_Clear)
+        painter.setPen(QtCore.Qt.NoPen)
+        painter.setBrush(QtCore.Qt.black)
+        painter.drawEllipse(ellipse)
+        painter.end()
+        self.revision += 1
+        return dirtyRect
+
+    def toPath(self):
+        """Traces the shown pixels. This is slow, so the result is cached."""
+        if self._pathRevision != self.revision:
+            bitmap = QtGui.QBitmap.fromImage(self.image.createAlphaMask())
+            self._path = QtGui.QPainterPath()
+            self._path.addRegion(QtGui.QRegion(bitmap))
+            self._pathRevision = self.revision
+        return QtGui.QPainterPath(self._path)
+
+    def boundingRect(self):
+        """The bounds of the shown pixels."""
+        self.toPath()
+        return self._path.boundingRect()
+
+    def contentHash(self):
+        if self._hashRevision != self.revision:
+            image = self.image
+            digest = hashlib.sha1(b'%dx%d:' % (image.width(), image.height()))
+            digest.update(image.bits().asstring(image.byteCount()))
+            self._hash = digest.hexdigest()
+            self._hashRevision = self.revision
+        return self._hash
+
+
 class SkinGraphicsItem(QtGui.QGraphicsItemGroup):
     """
-    This serves as a container for a limb's skins.
+    This serves as a container for a limb's skins. The skins are positioned
+    at its origin and share its SkinMask, which starts out as the opaque
+    area of the diffuse image.
     """
     _diffuseItem = None
     _normalItem = None
-    _clippingPath = None
+    _mask = None
     _isEditable = False
 
-    def __init__(self, parent=None):
-        super(SkinGraphicsItem, self).__init__(parent)
-        self._clippingPath = QtGui.QPainterPath()
-        self.setFlag(QtGui.QGraphicsItem.ItemClipsChildrenToShape, True)
-
-    def shape(self):
-        return self._clippingPath
+    @property
+    def mask(self):
+        return self._mask
 
     @property
     def diffuseItem(self):
@@ -120,10 +200,13 @@ class SkinGraphicsItem(QtGui.QGraphicsItemGroup):
     
     @diffuseItem.setter
     def diffuseItem(self, diffuseItem):
-        self._clippingPath = diffuseItem.opaqueArea()
+        self._mask = SkinMask.fromPixmap(diffuseItem.pixmap())
         self._diffuseItem = diffuseItem
         diffuseItem.setParentItem(self)
         self.addToGroup(diffuseItem)
+        for item in (self._diffuseItem, self._normalItem):
+            if item:
+                item.maskChanged()
     
     @property
     def normalItem(self):
@@ -134,6 +217,7 @@ class SkinGraphicsItem(QtGui.QGraphicsItemGroup):
         self._normalItem = normalItem
         normalItem.setParentItem(self)
         self.addToGroup(normalItem)
+        normalItem.maskChanged()
     
     @property
     def isEditable(self):
@@ -153,49 +237,159 @@ class SkinGraphicsItem(QtGui.QGraphicsItemGroup):
         else:
             self.setOpacity(opacity)
 
-    def addToMask(self, pos, width, height, unmask=False):
-        halfWidth = width * 0.5
-        halfHeight = height * 0.5
-        thisPath = QtGui.QPainterPath()
-        thisPath.addEllipse(pos, width, height)
-        if unmask:
-            self._clippingPath = self._clippingPath.united(thisPath)
+    def setSkinsCached(self, cached):
+        """
+        Caches the rendered skins in device coordinates, which is worth it
+        while the limb holds still, e.g. while trimming, but not while it
+        is being animated.
+        """
+        if cached:
+            cacheMode = QtGui.QGraphicsItem.DeviceCoordinateCache
         else:
-            self._clippingPath = self._clippingPath.subtracted(thisPath)
-        x = pos.x()
-        y = pos.y()
-        targetRect = QtCore.QRectF(x - halfWidth, y - halfHeight, x + halfWidth, y + halfHeight)
-        if self.diffuseItem:
-            self.diffuseItem.update(targetRect)
-        if self.normalItem:
-            self.normalItem.update(targetRect)
+            cacheMode = QtGui.QGraphicsItem.NoCache
+        for item in (self._diffuseItem, self._normalItem):
+            if item:
+                item.setCacheMode(cacheMode)
+
+    def addToMask(self, pos, radiusX, radiusY, unmask=False):
+        """
+        Trims an ellipse around pos, in item coordinates, off the skins, or
+        shows it again if unmask is set. Returns the QRectF which changed.
+        """
+        if self._mask is None:
+            return QtCore.QRectF()
+        dirtyRect = self._mask.stamp(pos, radiusX, radiusY, reveal=unmask)
+        if not dirtyRect.isEmpty():
+            for item in (self._diffuseItem, self._normalItem):
+                if item:
+                    item.maskChanged(dirtyRect)
+        return QtCore.QRectF(dirtyRect)
 
 
 class MaskedSkinItem(QtGui.QGraphicsPixmapItem):
     """    
-    Looks to its parent for a clip path.
+    Looks to its parent for a SkinMask. The masked pixels are kept in an
+    image which is only recomposited where the mask changed, once per
+    repaint however many times it changed in between.
     """
-    def getClippedPixmap(self):
+    _sourceHash = None
+    _sourceHashKey = None
+    _maskedImage = None
+    # the QRect of _maskedImage which is out of date
+    _dirtyRect = None
+
+    def __init__(self, *args):
+        super(MaskedSkinItem, self).__init__(*args)
+        self.setFlag(QtGui.QGraphicsItem.ItemUsesExtendedStyleOption, True)
+
+    def getMask(self):
+        return getattr(self.parentItem(), 'mask', None)
+
+    def maskChanged(self, rect=None):
         """
-        Returns a clipped copy of this image and and offset from the
-        original, full image.
-        TODO: I imagine there is a one or two-liner of Qt that can 
-        replace this. 
+        Call after the mask changed within rect (a QRect), or entirely if
+        rect is None. Only rect is repainted; Qt merges the updates made
+        before the next repaint.
         """
-        clipPath = QtGui.QPainterPath(self.parentItem()._clippingPath)
-        clipRect = clipPath.boundingRect()
-        offset = clipRect.topLeft()
-        clipPath.translate(-offset)
-        clippedPix = QtGui.QPixmap(clipRect.size().toSize())
-        clippedPix.fill(QtGui.QColor(0, 0, 0, 0))
+        mask = self.getMask()
+        if mask is None:
+            self._maskedImage = self._dirtyRect = None
+            self.update()
+            return
+        if self._maskedImage is None or rect is None:
+            self._maskedImage = QtGui.QImage(
+                self.pixmap().size(), QtGui.QImage.Format_ARGB32_Premultiplied)
+            self._dirtyRect = None
+            self.update()
+            rect = self._maskedImage.rect()
+        rect = rect.intersected(self._maskedImage.rect())
+        if self._dirtyRect is None:
+            self._dirtyRect = rect
+        else:
+            self._dirtyRect = self._dirtyRect.united(rect)
+        self.update(QtCore.QRectF(rect).translated(self.offset()))
+
+    def _composite(self):
+        """Brings the dirty part of the masked image up to date."""
+        rect = self._dirtyRect
+        if rect is None:
+            return
+        self._dirtyRect = None
+        mask = self.getMask()
         painter = QtGui.QPainter()
-        if painter.begin(clippedPix):
-            painter.setClipPath(clipPath)
-            painter.drawPixmap(QtCore.QPointF(), self.pixmap(), clipRect)
+        if painter.begin(self._maskedImage):
+            painter.setCompositionMode(QtGui.QPainter.CompositionMode_Source)
+            painter.fillRect(rect, QtCore.Qt.transparent)
+            painter.drawImage(rect, mask.image, rect)
+            painter.setCompositionMode(QtGui.QPainter.CompositionMode_SourceIn)
+            painter.drawPixmap(rect, self.pixmap(), rect)
             painter.end()
         else:
             print('Failed to start painting MaskedSkinItem')
-        return clippedPix, offset
+
+    def paint(self, painter, option, widget=None):
+        if self._maskedImage is None:
+            return super(MaskedSkinItem, self).paint(painter, option, widget)
+        self._composite()
+        painter.setRenderHint(
+            QtGui.QPainter.SmoothPixmapTransform,
+            self.transformationMode() == QtCore.Qt.SmoothTransformation)
+        offset = self.offset()
+        source = option.exposedRect.translated(-offset).intersected(
+            QtCore.QRectF(self._maskedImage.rect()))
+        painter.drawImage(source.translated(offset), self._maskedImage, source)
+
+    def getClipPath(self):
+        mask = self.getMask()
+        if mask is None:
+            path = QtGui.QPainterPath()
+            path.addRect(self.boundingRect())
+            return path
+        return mask.toPath()
+
+    def getClipRect(self):
+        mask = self.getMask()
+        if mask is None:
+            return self.boundingRect()
+        return mask.boundingRect()
+
+    def getClippedPixmap(self):
+        """
+        Returns a clipped copy of this image and and offset from the
+        original, full image.
+        """
+        clippedImage, offset = self.getClippedImage()
+        return QtGui.QPixmap.fromImage(clippedImage), offset
+
+    def getClippedImage(self):
+        """
+        Same as getClippedPixmap but returns a QImage which, unlike a QPixmap,
+        can be handed to other threads for encoding.
+        """
+        clipRect = self.getClipRect()
+        image = self._maskedImage
+        if image is None:
+            image = self.pixmap().toImage()
+        else:
+            self._composite()
+        return image.copy(clipRect.toRect()), clipRect.topLeft()
+
+    def contentHash(self):
+        """
+        A hash of the source pixels and the mask which identifies the image
+        returned by getClippedImage without having to render it.
+        """
+        pixmap = self.pixmap()
+        if self._sourceHashKey != pixmap.cacheKey():
+            image = pixmap.toImage()
+            pixels = image.bits().asstring(image.byteCount())
+            self._sourceHash = hashlib.sha1(pixels).hexdigest()
+            self._sourceHashKey = pixmap.cacheKey()
+        digest = hashlib.sha1(self._sourceHash.encode('ascii'))
+        mask = self.getMask()
+        if mask is not None:
+            digest.update(mask.contentHash().encode('ascii'))
+        return digest.hexdigest()
 
 
 class BoneGraphicsItem(QtGui.QGraphicsObject):
@@ -130,16 +130,25 @@ class TrimSkinsDelegate(ChopHumanDelegate):
     isDragging = False
     isMasking = True
     hotKey = 'd'
+    brushRadius = 10
+    trimmedSkinItem = None
 
     def enable(self):
         if self.window.selectedBoneItem:
             self.onBoneSelected(self.window.selectedBoneItem, None)
         self.window.pushCursor(QtCore.Qt.CrossCursor)
+        # the skins hold still in this mode, so repaints around the brush
+        # come from their caches; see onSceneMousePressEvent
+        for skinItem in self.window.skinItemMap.values():
+            skinItem.setSkinsCached(True)
 
     def disable(self):
         if self.window.selectedBoneItem:
             self.onBoneSelected(None, self.window.selectedBoneItem)
         self.window.popCursor()
+        self.onSceneMouseReleaseEvent(None)
+        for skinItem in self.window.skinItemMap.values():
+            skinItem.setSkinsCached(False)
 
     def onBoneSelected(self, current, previous):
         if previous:
@@ -168,11 +177,12 @@ class TrimSkinsDelegate(ChopHumanDelegate):
         if selectedBoneItem:
             skinItem = self.window.skinItemMap.get(selectedBoneItem.bone.name, None)
             if skinItem:
-                targetPos = skinItem.mapFromScene(event.scenePos())
                 self.isDragging = True
                 self.isMasking = event.button() == QtCore.Qt.LeftButton
-                skinItem.addToMask(targetPos, 10, 10, unmask=not self.isMasking)
-                self.window.scene.update()
+                # the trimmed skin paints directly while it changes
+                self.trimmedSkinItem = skinItem
+                skinItem.setSkinsCached(False)
+                self.trim(skinItem, event.scenePos())
         else:
             event.ignore()
 
@@ -182,13 +192,22 @@ class TrimSkinsDelegate(ChopHumanDelegate):
             if selectedBoneItem:
                 skinItem = self.window.skinItemMap.get(selectedBoneItem.bone.name, None)
                 if skinItem:
-                    targetPos = skinItem.mapFromScene(event.scenePos())
-                    #targetPos = event.scenePos() - selectedBoneItem.scenePos()
-                    skinItem.addToMask(targetPos, 10, 10, unmask=not self.isMasking)
-            self.window.scene.update()
+                    self.trim(skinItem, event.scenePos())
+
+    def trim(self, skinItem, scenePos):
+        """
+        Stamps the brush into the skin's mask; the skin repaints just the
+        footprint of the brush.
+        """
+        targetPos = skinItem.mapFromScene(scenePos)
+        radius = self.brushRadius
+        skinItem.addToMask(targetPos, radius, radius, unmask=not self.isMasking)
 
     def onSceneMouseReleaseEvent(self, event):
         self.isDragging = False
+        if self.trimmedSkinItem:
+            self.trimmedSkinItem.setSkinsCached(True)
+            self.trimmedSkinItem = None
 
 
 class PoseDelegate(ChopHumanDelegate):
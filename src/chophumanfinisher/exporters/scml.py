@@ -1,166 +1,246 @@
 import math
 import os
 from collections import defaultdict
-import elementtree.ElementTree as ET
+from multiprocessing.pool import ThreadPool
+from PyQt4 import QtCore
+from chophumanfinisher.models import pose
 from chophumanfinisher.models.skeleton import HUMAN_LIMB_ORDER, normalizeAngle
 from .base import ChopHumanExporter
+from .xmlwriter import XMLWriter
 
 
 class SCMLExporter(ChopHumanExporter):
     """
-    Exports to SCML. 
+    Exports to SCML.
+    The file is written in a single pass, one animation at a time.
     """
     fileType = ('Spriter', 'scml')
     version = '0.00001'
-    
+    # threads used to encode skin images, None for one per cpu
+    encoderThreads = None
+
+    def __init__(self):
+        # encoded PNG data by content hash of the skins in the last export,
+        # reused when the same exporter exports again
+        self.encodedImages = {}
+        # (content hash, modification time) of the image files this
+        # exporter wrote, by path. This is kept in memory rather than in
+        # the export so that nothing but the project ends up there; the
+        # first export of a session writes every image.
+        self.writtenImages = {}
+
     def export(self, animationSet, skinItemMap, outputFilepath):
         self.animationSet = animationSet
         self.skinItemMap = skinItemMap
-    
-        root = ET.Element('spriter_data')
-        root.set('scml_version', '1.0')
-        root.set('generator', 'ChopHuman SCML Exporter')
-        root.set('generator_version', self.version)
-        
-        outputPath, fileName = os.path.split(outputFilepath)
-        self.outputPath = outputPath
 
-        projectName, _ = fileName.split('.')
+        outputPath, fileName = os.path.split(outputFilepath)
+        projectName, _ = os.path.splitext(fileName)
         self.outputPath = outputPath
         self.projectName = projectName
-        self.folder = folder = ET.SubElement(root, 'folder')
-        folder.set('id', '0')
-        folder.set('name', projectName)
         try:
             os.mkdir(os.path.join(outputPath, projectName))
         except OSError:
             pass # already exists
 
-        entity = ET.SubElement(root, 'entity')
-        entity.set('id', '0')
-        entity.set('name', projectName)
-        
         boneSkinMap = self.prepareSkins()
 
-        for animation in animationSet.animations:
-            animationNode = ET.SubElement(entity, 'animation')
-            animationNode.set('id', str(animation.id))
-            animationNode.set('name', str(animation.name))
-            animationNode.set('length', str(animation.length))
-            if animation.looping:
-                animationNode.set('looping', 'true')
-            else:
-                animationNode.set('looping', 'false')
-
-            boneTimelines = {}
-            objectTimelines = {}
-            mainlineNode = ET.SubElement(animationNode, 'mainline')    
-            for keyframe in animation.keyframes:
-                keyNode = ET.SubElement(mainlineNode, 'key')
-                keyNode.set('id', str(keyframe.id))
-                keyNode.set('time', str(keyframe.time))
-                for bone in keyframe.entityState.bones:
-                    boneRefNode = ET.SubElement(keyNode, 'bone_ref')
-                    boneRefNode.set('id', str(bone.id))
-                    if bone.parent != -1:
-                        boneRefNode.set('parent', str(bone.parent))
-                    boneRefNode.set('timeline', str(bone.id))
-                    boneRefNode.set('key', str(keyframe.id))
-                    timelineNode = boneTimelines.get(bone.id, None)
-                    if not timelineNode:
-                        timelineNode = ET.SubElement(animationNode, 'timeline')
-                        timelineNode.set('id', str(bone.id))
-                        timelineNode.set('name', str(bone.name))
-                        boneTimelines[bone.id] = timelineNode
-                    bt = bone.transform
-                    boneKeyNode = ET.SubElement(timelineNode, 'key')
-                    boneKeyNode.set('id', str(keyframe.id))
-                    boneKeyNode.set('spin', str(bt.spin))
-                    boneKeyNode.set('time', str(keyframe.time))
-                    boneNode = ET.SubElement(boneKeyNode, 'bone')
-                    boneNode.set('x', str(bt.x))
-                    boneNode.set('y', str(-bt.y))
-                    boneNode.set('angle', str(-normalizeAngle(bt.angle)))
-                    boneNode.set('scale_x', str(bt.scaleX))
-                    boneNode.set('scale_y', str(bt.scaleY))
-                    
-                baseObjectId = bone.id + 1
-                objectId = 0
-                for skin in keyframe.entityState.skins:
-                    bone = keyframe.entityState.bones[skin.parent]
-                    boneSkins = boneSkinMap[bone.name]
-                    for fileId, name, filename, boneName, item, offset in boneSkins:
-                        timelineId = objectId + baseObjectId
-                        objRefNode = ET.SubElement(keyNode, 'object_ref')
-                        objRefNode.set('id', str(objectId))
-                        objRefNode.set('parent', str(skin.parent))
-                        objRefNode.set('timeline', str(timelineId))
-                        objRefNode.set('key', str(keyframe.id))
-                        objRefNode.set('z_index', str(objectId))
-                        timelineNode = objectTimelines.get(objectId, None)
-                        if not timelineNode:
-                            timelineNode = ET.SubElement(animationNode, 'timeline')
-                            timelineNode.set('id', str(timelineId))
-                            timelineNode.set('name', str(name))
-                            objectTimelines[objectId] = timelineNode
-                        ot = skin.transform
-                        objKeyNode = ET.SubElement(timelineNode, 'key')
-                        objKeyNode.set('id', str(keyframe.id))
-                        objKeyNode.set('spin', str(ot.spin))
-                        objKeyNode.set('time', str(keyframe.time))
-                        objNode = ET.SubElement(objKeyNode, 'object')
-                        objNode.set('folder', '0')
-                        objNode.set('file', str(fileId))
-                        ca = math.cos(ot.angleRadians)
-                        sa = math.sin(ot.angleRadians)
-                        tmpX = offset.x()
-                        tmpY = offset.y()
-                        offsetX = tmpX * ca - tmpY * sa
-                        offsetY = tmpX * sa + tmpY * ca 
-                        objNode.set('x', str(ot.x + offsetX))
-                        objNode.set('y', str(-(ot.y + offsetY)))
-                        objNode.set('angle', str(normalizeAngle(-ot.angle)))
-                        objectId += 1
-            tree = ET.ElementTree(root)
-            tree.write(outputFilepath, encoding='utf-8')
+        with open(outputFilepath, 'wb') as outputFile:
+            writer = XMLWriter(outputFile)
+            writer.declaration()
+            writer.start('spriter_data', (
+                ('scml_version', '1.0'),
+                ('generator', 'ChopHuman SCML Exporter'),
+                ('generator_version', self.version),
+            ))
+            writer.start('folder', (('id', 0), ('name', projectName)))
+            for fileId, filename, width, height in self.skinFiles:
+                writer.element('file', (
+                    ('id', fileId),
+                    ('name', filename),
+                    ('width', width),
+                    ('height', height),
+                ))
+            writer.end('folder')
+            writer.start('entity', (('id', 0), ('name', projectName)))
+            for animation in animationSet.animations:
+                self._writeAnimation(writer, animation, boneSkinMap)
+            writer.end('entity')
+            writer.end('spriter_data')
+
+    def _writeAnimation(self, writer, animation, boneSkinMap):
+        writer.start('animation', (
+            ('id', animation.id),
+            ('name', animation.name),
+            ('length', animation.length),
+            ('looping', bool(animation.looping)),
+        ))
+        keyframes = animation.keyframes
+        if not keyframes:
+            writer.end('animation')
+            return
+        # the bones and skins are the same for every keyframe of an animation
+        entityState = keyframes[0].entityState
+        bones = entityState.bones
+        objects = self._getObjects(entityState, boneSkinMap)
+        baseObjectId = bones[-1].id + 1 if bones else 0
+
+        writer.start('mainline')
+        for keyframe in keyframes:
+            keyId = keyframe.id
+            writer.start('key', (('id', keyId), ('time', keyframe.time)))
+            for bone in bones:
+                attributes = [('id', bone.id)]
+                if bone.parent != -1:
+                    attributes.append(('parent', bone.parent))
+                attributes.extend((('timeline', bone.id), ('key', keyId)))
+                writer.element('bone_ref', attributes)
+            for objectId, skin, fileData in objects:
+                writer.element('object_ref', (
+                    ('id', objectId),
+                    ('parent', skin.parent),
+                    ('timeline', objectId + baseObjectId),
+                    ('key', keyId),
+                    ('z_index', objectId),
+                ))
+            writer.end('key')
+        writer.end('mainline')
+
+        for boneIndex, bone in enumerate(bones):
+            writer.start('timeline', (('id', bone.id), ('name', bone.name)))
+            for keyframe in keyframes:
+                channels = keyframe.entityState.boneChannels[boneIndex]
+                writer.start('key', (
+                    ('id', keyframe.id),
+                    ('spin', int(channels[pose.SPIN])),
+                    ('time', keyframe.time),
+                ))
+                writer.element('bone', (
+                    ('x', float(channels[pose.X])),
+                    ('y', -float(channels[pose.Y])),
+                    ('angle', -normalizeAngle(float(channels[pose.ANGLE]))),
+                    ('scale_x', float(channels[pose.SCALE_X])),
+                    ('scale_y', float(channels[pose.SCALE_Y])),
+                ))
+                writer.end('key')
+            writer.end('timeline')
+
+        for objectId, skin, fileData in objects:
+            fileId, name, filename, boneName, item, offset = fileData
+            writer.start('timeline', (('id', objectId + baseObjectId), ('name', name)))
+            for keyframe in keyframes:
+                channels = keyframe.entityState.skinChannels[skin.id]
+                angle = float(channels[pose.ANGLE])
+                ca = math.cos(math.radians(angle))
+                sa = math.sin(math.radians(angle))
+                tmpX = offset.x()
+                tmpY = offset.y()
+                offsetX = tmpX * ca - tmpY * sa
+                offsetY = tmpX * sa + tmpY * ca
+                writer.start('key', (
+                    ('id', keyframe.id),
+                    ('spin', int(channels[pose.SPIN])),
+                    ('time', keyframe.time),
+                ))
+                writer.element('object', (
+                    ('folder', 0),
+                    ('file', fileId),
+                    ('x', float(channels[pose.X]) + offsetX),
+                    ('y', -(float(channels[pose.Y]) + offsetY)),
+                    ('angle', normalizeAngle(-angle)),
+                ))
+                writer.end('key')
+            writer.end('timeline')
+        writer.end('animation')
+
+    def _getObjects(self, entityState, boneSkinMap):
+        """
+        Returns (objectId, skin, fileData) for each image of each skin.
+        """
+        objects = []
+        for skin in entityState.skins:
+            bone = entityState.bones[skin.parent]
+            for fileData in boneSkinMap[bone.name]:
+                objects.append((len(objects), skin, fileData))
+        return objects
 
     def prepareSkins(self):
+        """
+        Writes the skin images and returns a map of bone names to the data
+        of their images. The clipped images are encoded to PNG on a pool of
+        threads. Image files this exporter already wrote with the same
+        content, and which weren't touched since, are not written again,
+        and images encoded by the previous export are reused.
+        """
         boneSkinMap = defaultdict(list)
+        self.skinFiles = []
+        hashes = {}
+        pool = ThreadPool(self.encoderThreads)
+        results = []
         nextFileId = 0
-        for boneName, skinItem in self.skinItemMap.items():
-            items = []
-            normalItem = skinItem.normalItem
-            if normalItem:
-                itemName = '%s_n' % boneName
-                filename = self._relativeFilename(itemName + '.png')
-                pixmap, offset = normalItem.getClippedPixmap()
-                pixmap.save(os.path.join(self.outputPath, filename))
-                data = (nextFileId, itemName, filename, boneName, normalItem, offset)
-                boneSkinMap[boneName].append(data)
-                items.append(data)
-                nextFileId += 1
-            diffuseItem = skinItem.diffuseItem
-            if diffuseItem:
-                itemName = '%s_d' % boneName
-                filename = self._relativeFilename(itemName + '.png')
-                pixmap, offset = diffuseItem.getClippedPixmap()
-                pixmap.save(os.path.join(self.outputPath, filename))
-                data = (nextFileId, itemName, filename, boneName, diffuseItem, offset)
-                boneSkinMap[boneName].append(data)
-                items.append(data)
-                nextFileId += 1
-            # add the file nodes to the folder
-            for data in items:
-                fileId, name, filename, boneName, item, offset = data
-                elFile = ET.SubElement(self.folder, 'file')
-                elFile.set('id', str(fileId))
-                elFile.set('name', filename)
-                itemBounds = item.boundingRect()
-                elFile.set('width', str(int(itemBounds.width())))
-                elFile.set('height', str(int(itemBounds.height())))
+        try:
+            for boneName, skinItem in self.skinItemMap.items():
+                for suffix, item in (('n', skinItem.normalItem), ('d', skinItem.diffuseItem)):
+                    if not item:
+                        continue
+                    itemName = '%s_%s' % (boneName, suffix)
+                    filename = self._relativeFilename(itemName + '.png')
+                    filepath = os.path.join(self.outputPath, filename)
+                    digest = item.contentHash()
+                    offset = item.getClipRect().topLeft()
+                    hashes[filepath] = digest
+                    encoded = self.encodedImages.get(digest)
+                    if self.writtenImages.get(filepath) == (digest, _modificationTime(filepath)):
+                        pass # unchanged since the last export
+                    elif encoded is not None:
+                        results.append(pool.apply_async(_writeFile, (filepath, encoded)))
+                    else:
+                        image, _ = item.getClippedImage()
+                        results.append(pool.apply_async(
+                            _encodeImage, (image, filepath, digest, self.encodedImages)))
+                    data = (nextFileId, itemName, filename, boneName, item, offset)
+                    boneSkinMap[boneName].append(data)
+                    itemBounds = item.boundingRect()
+                    self.skinFiles.append((
+                        nextFileId, filename,
+                        int(itemBounds.width()), int(itemBounds.height())
+                    ))
+                    nextFileId += 1
+            for result in results:
+                result.get()
+        finally:
+            pool.close()
+            pool.join()
+        currentDigests = set(hashes.values())
+        for digest in list(self.encodedImages):
+            if digest not in currentDigests:
+                del self.encodedImages[digest]
+        for filepath, digest in hashes.items():
+            self.writtenImages[filepath] = (digest, _modificationTime(filepath))
         return boneSkinMap
-    
+
     def _relativeFilename(self, filename):
         return os.path.join(self.projectName, filename)
 
 
+def _modificationTime(filepath):
+    try:
+        return os.path.getmtime(filepath)
+    except OSError:
+        return None
+
+
+def _writeFile(filepath, data):
+    with open(filepath, 'wb') as outputFile:
+        outputFile.write(data)
+
+
+def _encodeImage(image, filepath, digest, encodedImages):
+    """Encodes a QImage to PNG; this is safe to run outside the GUI thread."""
+    encoded = QtCore.QByteArray()
+    outputBuffer = QtCore.QBuffer(encoded)
+    outputBuffer.open(QtCore.QIODevice.WriteOnly)
+    image.save(outputBuffer, 'PNG')
+    outputBuffer.close()
+    data = encoded.data()
+    encodedImages[digest] = data
+    _writeFile(filepath, data)
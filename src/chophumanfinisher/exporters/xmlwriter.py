@@ -0,0 +1,63 @@
+"""
+A minimal streaming XML writer so exporters don't need to build a tree.
+"""
+from xml.sax.saxutils import quoteattr
+
+
+def formatFloat(value):
+    """Formats floats the same way on every platform and Python version."""
+    text = ('%.6f' % value).rstrip('0').rstrip('.')
+    if text == '-0':
+        text = '0'
+    return text
+
+
+def formatValue(value):
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, float):
+        return formatFloat(value)
+    return u'%s' % value
+
+
+class XMLWriter(object):
+    """
+    Writes elements to a file as they are produced. Attributes are given as
+    a sequence of (name, value) pairs and written in that order.
+    """
+    def __init__(self, outputFile, indent='    ', encoding='utf-8'):
+        self.outputFile = outputFile
+        self.indent = indent
+        self.encoding = encoding
+        self._openTags = []
+
+    def declaration(self):
+        self._write(u'<?xml version="1.0" encoding="%s"?>\n' % self.encoding.upper())
+
+    def start(self, tag, attributes=()):
+        self._write(self._tag(tag, attributes, u'>'))
+        self._openTags.append(tag)
+
+    def end(self, tag):
+        openTag = self._openTags.pop()
+        if openTag != tag:
+            raise ValueError('Closing <%s> while <%s> is open' % (tag, openTag))
+        self._write(u'%s</%s>\n' % (self.indent * len(self._openTags), tag))
+
+    def element(self, tag, attributes=()):
+        self._write(self._tag(tag, attributes, u'/>'))
+
+    def close(self):
+        while self._openTags:
+            self.end(self._openTags[-1])
+
+    def _tag(self, tag, attributes, ending):
+        parts = [self.indent * len(self._openTags), u'<', tag]
+        for name, value in attributes:
+            parts.append(u' %s=%s' % (name, quoteattr(formatValue(value))))
+        parts.append(ending)
+        parts.append(u'\n')
+        return u''.join(parts)
+
+    def _write(self, text):
+        self.outputFile.write(text.encode(self.encoding))
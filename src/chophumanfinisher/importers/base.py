@@ -7,7 +7,12 @@ class ChopHumanImporter(object):
     fileType = ('Base Importer', '*')
     version = '0.0'
 
-    def importFile(self, filename):
+    def importFile(self, filename, lazy=False):
+        """
+        Returns a list of AnimationSets and a map of skin ids to file data.
+        If lazy is True, importers that support it may postpone reading each
+        animation until it is used.
+        """
         pass
 
     @classmethod
@@ -0,0 +1,219 @@
+"""
+A binary sidecar cache for imported AnimationSets.
+
+Layout (all little-endian):
+    magic       8 bytes, CACHE_MAGIC
+    version     uint32, CACHE_VERSION
+    headerSize  uint32
+    header      headerSize bytes of utf-8 JSON describing the importer and
+                the source file, the skin files and the entities,
+                animations and keyframes
+    padding     up to the next multiple of 8 bytes
+    data        float64 channel arrays; for every animation a
+                (keyframes x bones x channels) block followed by a
+                (keyframes x skins x channels) block (see models.pose)
+
+The data section is memory-mapped when the cache is read and the keyframe
+EntityStates use views into it directly, so loading does not copy or parse
+any channel data. A cache is only used if it was written from the same
+source file by the same version of the same importer.
+"""
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import numpy
+from chophumanfinisher.models import pose
+from chophumanfinisher.models.animation import AnimationSet, Animation, Keyframe, EntityState
+
+
+CACHE_MAGIC = b'CHOPANIM'
+CACHE_VERSION = 2
+CACHE_EXTENSION = '.chcache'
+PREAMBLE = struct.Struct('<8sII')
+CHANNEL_DTYPE = numpy.dtype('<f8')
+
+
+def cachePath(sourcePath):
+    return sourcePath + CACHE_EXTENSION
+
+
+def fileHash(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as inputFile:
+        for chunk in iter(lambda: inputFile.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def canWriteCache(sourcePath):
+    """Whether the cache of sourcePath can be written next to it."""
+    return os.access(os.path.dirname(os.path.abspath(sourcePath)), os.W_OK)
+
+
+def writeCache(sourcePath, animationSets, skinFileMap, importer):
+    """
+    Writes the cache for sourcePath of what importer (a string naming the
+    importer and its version) imported. Returns False if the animation sets
+    can't be cached, i.e. if the keyframes of an animation differ in shape.
+    """
+    sourceStat = os.stat(sourcePath)
+    header = dict(
+        importer=importer,
+        source=dict(
+            mtime=sourceStat.st_mtime,
+            size=sourceStat.st_size,
+            sha1=fileHash(sourcePath)
+        ),
+        skinFiles=[
+            [skinId, fileData['folderId'], fileData['id'], fileData['name'],
+             fileData['width'], fileData['height']]
+            for skinId, fileData in skinFileMap.items()
+        ],
+        entities=[]
+    )
+    blocks = []
+    offset = 0
+    for animationSet in animationSets:
+        animations = []
+        for animation in animationSet.animations:
+            keyframes = animation.keyframes
+            if not keyframes:
+                return False
+            shape = keyframes[0].entityState.shape
+            for keyframe in keyframes:
+                if keyframe.entityState.shape != shape:
+                    return False
+            boneBlock = numpy.array(
+                [k.entityState.boneChannels for k in keyframes], dtype=CHANNEL_DTYPE)
+            skinBlock = numpy.array(
+                [k.entityState.skinChannels for k in keyframes], dtype=CHANNEL_DTYPE)
+            animations.append(dict(
+                id=animation.id,
+                name=animation.name,
+                length=animation.length,
+                looping=animation.looping,
+                keyframes=[[k.time, k.spin] for k in keyframes],
+                bones=shape[0],
+                skins=shape[1],
+                boneOffset=offset,
+                skinOffset=offset + boneBlock.nbytes
+            ))
+            blocks.extend((boneBlock, skinBlock))
+            offset += boneBlock.nbytes + skinBlock.nbytes
+        header['entities'].append(dict(name=animationSet.name, animations=animations))
+
+    headerBytes = json.dumps(header).encode('utf-8')
+    preambleSize = PREAMBLE.size + len(headerBytes)
+    padding = -preambleSize % CHANNEL_DTYPE.itemsize
+    path = cachePath(sourcePath)
+    # a private temporary file, as other processes may be writing the same
+    # cache, renamed into place once it is complete
+    fd, tempPath = tempfile.mkstemp(
+        prefix=os.path.basename(path) + '.', suffix='.tmp', dir=os.path.dirname(path))
+    try:
+        with os.fdopen(fd, 'wb') as outputFile:
+            outputFile.write(PREAMBLE.pack(CACHE_MAGIC, CACHE_VERSION, len(headerBytes)))
+            outputFile.write(headerBytes)
+            outputFile.write(b'\0' * padding)
+            for block in blocks:
+                outputFile.write(block.tobytes())
+        if os.name == 'nt' and os.path.exists(path):
+            # rename doesn't replace files on Windows
+            os.remove(path)
+        os.rename(tempPath, path)
+    except BaseException:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+        raise
+    return True
+
+
+def readCache(sourcePath, importer):
+    """
+    Returns (animationSets, skinFileMap) from the cache of sourcePath, or None
+    if there is no usable cache, it is out of date or another importer (see
+    writeCache) wrote it.
+    """
+    path = cachePath(sourcePath)
+    if not os.path.exists(path) or os.path.getsize(path) < PREAMBLE.size:
+        return None
+    with open(path, 'rb') as inputFile:
+        data = mmap.mmap(inputFile.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _readCacheData(sourcePath, importer, data)
+    except (ValueError, KeyError, TypeError, struct.error):
+        return None
+
+
+def _readCacheData(sourcePath, importer, data):
+    magic, version, headerSize = PREAMBLE.unpack_from(data, 0)
+    if magic != CACHE_MAGIC or version != CACHE_VERSION:
+        return None
+    header = json.loads(data[PREAMBLE.size:PREAMBLE.size + headerSize].decode('utf-8'))
+    if header['importer'] != importer or not _isCurrent(sourcePath, header['source']):
+        return None
+    dataOffset = PREAMBLE.size + headerSize
+    dataOffset += -dataOffset % CHANNEL_DTYPE.itemsize
+
+    basePath = os.path.dirname(sourcePath)
+    skinFileMap = {}
+    for skinId, folderId, fileId, name, width, height in header['skinFiles']:
+        skinFileMap[skinId] = dict(
+            id=fileId,
+            folderId=folderId,
+            name=name,
+            filename=os.path.join(basePath, name),
+            width=width,
+            height=height
+        )
+
+    animationSets = []
+    for entityData in header['entities']:
+        animationSet = AnimationSet()
+        animationSet.name = entityData['name']
+        for animationData in entityData['animations']:
+            animationSet.addAnimation(
+                _readAnimation(data, dataOffset, animationData))
+        animationSets.append(animationSet)
+    return animationSets, skinFileMap
+
+
+def _isCurrent(sourcePath, sourceData):
+    sourceStat = os.stat(sourcePath)
+    if sourceStat.st_size != sourceData['size']:
+        return False
+    if sourceStat.st_mtime == sourceData['mtime']:
+        return True
+    return fileHash(sourcePath) == sourceData['sha1']
+
+
+def _readAnimation(data, dataOffset, animationData):
+    animation = Animation()
+    animation.id = animationData['id']
+    animation.name = animationData['name']
+    animation.length = animationData['length']
+    animation.looping = animationData['looping']
+    boneShape = tuple(
+        None if boneMeta is None else tuple(boneMeta)
+        for boneMeta in animationData['bones']
+    )
+    skinShape = tuple(tuple(skinMeta) for skinMeta in animationData['skins'])
+    shape = (boneShape, skinShape)
+    keyCount = len(animationData['keyframes'])
+    boneBlock = numpy.frombuffer(
+        data, CHANNEL_DTYPE, keyCount * len(boneShape) * pose.TRANSFORM_CHANNELS,
+        dataOffset + animationData['boneOffset']
+    ).reshape(keyCount, len(boneShape), pose.TRANSFORM_CHANNELS)
+    skinBlock = numpy.frombuffer(
+        data, CHANNEL_DTYPE, keyCount * len(skinShape) * pose.SKIN_CHANNELS,
+        dataOffset + animationData['skinOffset']
+    ).reshape(keyCount, len(skinShape), pose.SKIN_CHANNELS)
+    for keyId, (time, spin) in enumerate(animationData['keyframes']):
+        entityState = EntityState.fromChannels(shape, boneBlock[keyId], skinBlock[keyId])
+        keyframe = Keyframe(keyId, time, entityState)
+        keyframe.spin = spin
+        animation.addKeyframe(keyframe)
+    return animation
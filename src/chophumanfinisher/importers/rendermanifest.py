@@ -0,0 +1,84 @@
+"""
+Reads the manifest.json which the Blender add-on (blender/addons/chophuman)
+writes next to the limb images it renders. It records the size of the
+rendered frame and, for every image, the bone it belongs to, whether it is a
+normal map, where in the frame it sits, where the bone's pivot is and a hash
+of the file, so that a character can be loaded without looking inside the
+images or guessing from their filenames.
+"""
+import hashlib
+import json
+import os
+import tempfile
+
+
+MANIFEST_FILENAME = 'manifest.json'
+MANIFEST_VERSION = 1
+# where the add-on writes when it isn't given an output path
+RENDER_DIRECTORY = os.path.join(tempfile.gettempdir(), 'chophuman')
+
+
+class RenderedImage(object):
+    """An image listed in a RenderManifest."""
+    def __init__(self, directory, entry):
+        self.filename = os.path.join(directory, entry['filename'])
+        self.boneName = entry['bone']
+        self.isNormalMap = entry['pass'] == 'normal'
+        # the top left corner of the image and the pivot of its bone, in
+        # pixels of the rendered frame
+        self.offset = tuple(entry['offset'])
+        self.pivot = tuple(entry['pivot']) if entry.get('pivot') else None
+        self.size = tuple(entry['size'])
+        self.contentHash = entry['hash']
+
+    def read(self):
+        """
+        Returns the contents of the image file, or None if it changed since
+        the manifest was written.
+        """
+        try:
+            with open(self.filename, 'rb') as imageFile:
+                data = imageFile.read()
+        except IOError:
+            return None
+        if hashlib.sha1(data).hexdigest() != self.contentHash:
+            return None
+        return data
+
+
+class RenderManifest(object):
+    def __init__(self, path, data):
+        self.path = path
+        self.directory = os.path.dirname(path)
+        self.frameSize = tuple(data['frame_size'])
+        self.images = [RenderedImage(self.directory, entry) for entry in data['images']]
+        self._imageMap = dict(
+            (os.path.normcase(os.path.abspath(image.filename)), image) for image in self.images)
+
+    @classmethod
+    def read(cls, path):
+        """
+        Returns the manifest at path, or None if it can't be read or was
+        written by another version of the add-on.
+        """
+        try:
+            with open(path) as manifestFile:
+                data = json.load(manifestFile)
+            if data.get('version') != MANIFEST_VERSION:
+                return None
+            return cls(path, data)
+        except (IOError, ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+    @classmethod
+    def find(cls, directory):
+        """Returns the manifest of the images in directory, or None."""
+        return cls.read(os.path.join(directory, MANIFEST_FILENAME))
+
+    def findImage(self, filename):
+        """Returns the RenderedImage of an image filename, or None."""
+        return self._imageMap.get(os.path.normcase(os.path.abspath(filename)))
+
+    def isCropped(self, image):
+        """Whether an image only covers the part of the frame its limb is in."""
+        return image.size != self.frameSize
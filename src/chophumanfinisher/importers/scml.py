@@ -1,10 +1,24 @@
 from collections import defaultdict
+from functools import partial
 import math
+import mmap
 import os
+import re
+import threading
+import warnings
+from xml.parsers import expat
 import elementtree.ElementTree as ET
 from chophumanfinisher.models.animation import AnimationSet, Animation, Keyframe, EntityState
 from chophumanfinisher.models.skeleton import Bone, Skin
 from .base import ChopHumanImporter
+from . import cache
+
+
+# the elements indexFile finds the byte ranges of
+INDEX_TAGS = ('entity', 'animation')
+# the rest of a start tag, quoted attribute values may contain '>'
+START_TAG_END_PATTERN = re.compile(br'(?:[^>"\']|"[^"]*"|\'[^\']*\')*>')
+XML_DECLARATION = '<?xml version="1.0" encoding="%s"?>\n'
 
 
 class SCMLImporter(ChopHumanImporter):
@@ -13,53 +27,238 @@ class SCMLImporter(ChopHumanImporter):
     """
     fileType = ('Spriter', 'scml')
     version = '0.00001'
+    # read and write a binary cache next to the imported file (see .cache)
+    useCache = True
+    # bump whenever what the importer produces changes, so that caches
+    # written by the previous version are ignored
+    cacheVersion = 1
+    # writes the cache of the last lazy import, if any
+    cacheThread = None
     
-    def importFile(self, inputFilepath):
-        inputDirectory, inputFilename = os.path.split(inputFilepath)
-        tree = ET.parse(inputFilepath)
-        root = tree.getroot()
+    def importFile(self, inputFilepath, lazy=False):
+        """
+        With lazy, animations are only parsed when they are first used. The
+        cache needs all of them, so it is then written by a background
+        thread (self.cacheThread) which imports the file on its own.
+        """
+        if self.useCache:
+            cached = cache.readCache(inputFilepath, self.cacheKey())
+            if cached:
+                animationSets, self.skinFileMap = cached
+                return animationSets, self.skinFileMap
+        if lazy:
+            indexed = self.indexFile(inputFilepath)
+            if self.useCache and cache.canWriteCache(inputFilepath):
+                self.cacheThread = threading.Thread(
+                    target=self.__class__().importFile, args=(inputFilepath,))
+                # an unfinished cache is simply written on another run
+                self.cacheThread.daemon = True
+                self.cacheThread.start()
+            return indexed
         animationSets = []
+        for event, item in self._iterParse(inputFilepath):
+            if event == 'entity':
+                animationSets.append(item)
+            else:
+                animationSets[-1].addAnimation(item)
+        if self.useCache:
+            try:
+                cache.writeCache(
+                    inputFilepath, animationSets, self.skinFileMap, self.cacheKey())
+            except (IOError, OSError) as e:
+                warnings.warn('Unable to write the animation cache: %s' % e, RuntimeWarning)
+        return animationSets, self.skinFileMap
+
+    @classmethod
+    def cacheKey(cls):
+        """Names this importer and its version in the caches it writes."""
+        return '%s %s/%d' % (cls.__name__, cls.version, cls.cacheVersion)
+
+    def iterAnimations(self, inputFilepath, animationFilter=None):
+        """
+        Lazily imports the animations of a file one at a time, yielding
+        (entityName, animation) tuples. If given, animationFilter is called
+        with the name of each animation and only those for which it returns
+        True are imported. self.skinFileMap is filled in as animations are
+        imported.
+        """
+        entityName = None
+        for event, item in self._iterParse(inputFilepath, animationFilter):
+            if event == 'entity':
+                entityName = item.name
+            else:
+                yield entityName, item
+
+    def _iterParse(self, inputFilepath, animationFilter=None):
+        """
+        Parses the file incrementally, yielding ('entity', animationSet)
+        when an entity starts and ('animation', animation) as each animation
+        is read. Processed elements are discarded so that only one animation
+        is held in memory at a time.
+        """
+        inputDirectory, inputFilename = os.path.split(inputFilepath)
         self.fileDataTable = defaultdict(dict)
         self.skinFileMap = {}
-        for folderNode in root.findall('folder'):
-            folderId = int(folderNode.get('id'))
-            folderName = folderNode.get('name')
-            basePath = inputDirectory
-            for fileNode in folderNode.findall('file'):
-                fileId = int(fileNode.get('id'))
-                name = fileNode.get('name')
-                data = dict(
-                    id=fileId,
-                    folderId=folderId,
-                    name=name,
-                    filename=os.path.join(basePath, name),
-                    width=int(fileNode.get('width')),
-                    height=int(fileNode.get('height'))
-                )
-                self.fileDataTable[folderId][fileId] = data
-
-        for entityNode in root.findall('entity'):
-            animationSet = self._importEntity(entityNode)
-            animationSets.append(animationSet)
+        elementStack = []
+        for event, elem in ET.iterparse(inputFilepath, events=('start', 'end')):
+            if event == 'start':
+                elementStack.append(elem)
+                if elem.tag == 'entity':
+                    animationSet = AnimationSet()
+                    animationSet.name = elem.get('name')
+                    yield 'entity', animationSet
+                continue
+            elementStack.pop()
+            if elem.tag == 'folder':
+                self._importFolder(elem, inputDirectory)
+            elif elem.tag == 'animation':
+                if animationFilter is None or animationFilter(elem.get('name')):
+                    yield 'animation', self._importAnimation(elem)
+            else:
+                continue
+            elem.clear()
+            if elementStack:
+                elementStack[-1].remove(elem)
+
+    def indexFile(self, inputFilepath):
+        """
+        Builds the AnimationSets of a file without parsing any animations.
+        The file is scanned by expat for the byte ranges of its <animation>
+        elements and each Animation only gets its id, name, length and
+        looping flag; its keyframes are parsed from that byte range the
+        first time they are used. The folders and the skins' files are
+        read in the same pass, so self.skinFileMap is complete up front.
+        self.animationIndex lists the animations that were found.
+        """
+        inputDirectory, inputFilename = os.path.split(inputFilepath)
+        self.fileDataTable = defaultdict(dict)
+        self.skinFileMap = {}
+        self.animationIndex = []
+        animationSets = []
+        with open(inputFilepath, 'rb') as inputFile:
+            if not os.fstat(inputFile.fileno()).st_size:
+                return animationSets, self.skinFileMap
+            data = mmap.mmap(inputFile.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                parser = expat.ParserCreate()
+                # the byte ranges are parsed on their own, so they need the
+                # encoding of the document
+                declaration = [XML_DECLARATION % 'utf-8']
+                openTags = []
+                # the folder, timeline and skin of each timeline of the
+                # element being read, see _importAnimation
+                current = dict(folder=None, timeline=None, timelineSkinMap={})
+
+                def onXmlDecl(version, encoding, standalone):
+                    if encoding:
+                        declaration[0] = XML_DECLARATION % encoding
 
+                def onStartElement(tag, attributes):
+                    if tag not in INDEX_TAGS:
+                        self._indexElement(tag, attributes, current, inputDirectory)
+                        return
+                    start = parser.CurrentByteIndex
+                    startTagEnd = START_TAG_END_PATTERN.match(data, start).end()
+                    isEmpty = data[startTagEnd - 2:startTagEnd] == b'/>'
+                    openTags.append((start, startTagEnd if isEmpty else None, attributes))
+                    if tag == 'entity':
+                        animationSet = AnimationSet()
+                        animationSet.name = attributes.get('name')
+                        animationSets.append(animationSet)
+                    else:
+                        current['timelineSkinMap'] = {}
+
+                def onEndElement(tag):
+                    if tag not in INDEX_TAGS:
+                        return
+                    start, end, attributes = openTags.pop()
+                    if end is None:
+                        # end tags have no attributes to hide a '>' in
+                        end = data.find(b'>', parser.CurrentByteIndex) + 1
+                    if tag == 'animation':
+                        animation = self._indexAnimation(
+                            attributes, inputFilepath, start, end - start, declaration[0])
+                        animationSets[-1].addAnimation(animation)
+                        self.animationIndex.append(dict(
+                            entityName=animationSets[-1].name,
+                            name=animation.name,
+                            length=animation.length,
+                            offset=start,
+                            size=end - start
+                        ))
+
+                parser.XmlDeclHandler = onXmlDecl
+                parser.StartElementHandler = onStartElement
+                parser.EndElementHandler = onEndElement
+                parser.ParseFile(inputFile)
+            finally:
+                data.close()
         return animationSets, self.skinFileMap
-    
-    def _importEntity(self, node):
-        animationSet = AnimationSet()
-        animationSet.name = node.get('name')
-        for animationNode in node.findall('animation'):
-            animation = self._importAnimation(animationNode)
-            animationSet.addAnimation(animation)
-        return animationSet
-
-    def _importAnimation(self, node):
+
+    def _indexElement(self, tag, attributes, current, inputDirectory):
+        """Reads what indexFile needs from the elements it doesn't skip."""
+        if tag == 'folder':
+            current['folder'] = int(attributes['id'])
+        elif tag == 'file':
+            self._importFile(current['folder'], attributes, inputDirectory)
+        elif tag == 'object_ref':
+            current['timelineSkinMap'][int(attributes['timeline'])] = int(attributes['id'])
+        elif tag == 'timeline':
+            current['timeline'] = int(attributes['id'])
+        elif tag == 'object':
+            skinId = current['timelineSkinMap'].get(current['timeline'])
+            if skinId is not None:
+                fileData = self.fileDataTable[int(attributes['folder'])][int(attributes['file'])]
+                self.skinFileMap[skinId] = fileData
+
+    def _indexAnimation(self, attributes, inputFilepath, offset, size, declaration):
         animation = Animation()
+        animation.id = int(attributes['id'])
+        animation.name = attributes['name']
+        animation.length = int(attributes['length'])
+        animation.looping = attributes.get('looping', 'true') == 'true'
+        animation.deferLoading(
+            partial(self._loadAnimation, inputFilepath, offset, size, declaration))
+        return animation
+
+    def _loadAnimation(self, inputFilepath, offset, size, declaration, animation):
+        with open(inputFilepath, 'rb') as inputFile:
+            inputFile.seek(offset)
+            node = ET.fromstring(declaration.encode('ascii') + inputFile.read(size))
+        self._importAnimation(node, animation)
+
+    def _importFolder(self, folderNode, basePath):
+        folderId = int(folderNode.get('id'))
+        for fileNode in folderNode.findall('file'):
+            self._importFile(folderId, fileNode.attrib, basePath)
+
+    def _importFile(self, folderId, attributes, basePath):
+        fileId = int(attributes['id'])
+        name = attributes['name']
+        data = dict(
+            id=fileId,
+            folderId=folderId,
+            name=name,
+            filename=os.path.join(basePath, name),
+            width=int(attributes['width']),
+            height=int(attributes['height'])
+        )
+        self.fileDataTable[folderId][fileId] = data
+
+    def _importAnimation(self, node, animation=None):
+        if animation is None:
+            animation = Animation()
         animation.id = int(node.get('id'))
         animation.name = node.get('name')
         animation.length = int(node.get('length'))
         animation.looping = node.get('looping', 'true') == 'true'
 
         timelineSkinMap = {}
+        timelineNodes = node.findall('timeline')
+        timelineNames = dict(
+            (int(timelineNode.get('id')), timelineNode.get('name', ''))
+            for timelineNode in timelineNodes
+        )
         lastKey = None
         # mainline
         for keyNode in node.findall('mainline/key'):
@@ -73,6 +272,7 @@ class SCMLImporter(ChopHumanImporter):
                 bone = Bone()
                 boneId = int(refNode.get('id'))
                 timelineId = int(refNode.get('timeline'))
+                bone.name = timelineNames.get(timelineId, '')
                 timelineBoneMap[boneId] = timelineId
                 bone.parent = int(refNode.get('parent', -1))
                 if bone.parent != -1:
@@ -81,21 +281,20 @@ class SCMLImporter(ChopHumanImporter):
             for refNode in keyNode.findall('object_ref'):
                 skin = Skin()
                 skinId = int(refNode.get('id'))
+                timelineId = int(refNode.get('timeline'))
+                skin.name = timelineNames.get(timelineId, '')
                 skin.parent = int(refNode.get('parent', -1))
                 if skin.parent != -1:
                     skin.parent = timelineBoneMap[skin.parent]
                 skin.zIndex = int(refNode.get('z_index'))
                 keyframe.entityState.addSkin(skin)
-                timelineId = int(refNode.get('timeline'))
                 timelineSkinMap[timelineId] = skinId
             animation.addKeyframe(keyframe)
             lastKey = keyframe
         lastKey.length = animation.length - lastKey.time
         # timelines
-        for timelineNode in node.findall('timeline'):
+        for timelineNode in timelineNodes:
             timelineId = int(timelineNode.get('id'))
-            timelineName = timelineNode.get('name', '')
-            lastKey = None
             for keyNode in timelineNode.findall('key'):
                 keyId = int(keyNode.get('id'))
                 spin = -int(keyNode.get('spin', 1))
@@ -105,7 +304,6 @@ class SCMLImporter(ChopHumanImporter):
                     skin = keyframe.entityState.skins[timelineSkinMap[timelineId]]
                     skinNode = keyNode.find('object')
                     transform = skin.transform
-                    skin.name = timelineName
                     folderId = int(skinNode.get('folder'))
                     fileId = int(skinNode.get('file'))
                     fileData = self.fileDataTable[folderId][fileId]
@@ -124,16 +322,12 @@ class SCMLImporter(ChopHumanImporter):
                     bone = keyframe.entityState.bones[timelineId]
                     boneNode = keyNode.find('bone')
                     transform = bone.transform
-                    bone.name = timelineName
                     transform.x = float(boneNode.get('x'))
                     transform.y = -float(boneNode.get('y'))
                     transform.angle = -float(boneNode.get('angle', 0.0))
                     transform.scaleX = float(boneNode.get('scale_x', 1.0))
                     transform.scaleY = float(boneNode.get('scale_y', 1.0))
                     transform.spin = spin
-                keyframe.entityState = keyframe.entityState.clone() # fixup names
-                lastKey = keyframe
+        animation.compact()
         return animation
-    
 
-        
\ No newline at end of file
@@ -1,3 +1,7 @@
+import bisect
+import numpy
+from . import pose
+from .skeleton import Bone, Skin
 
 
 class AnimationSet(object):
@@ -60,63 +64,149 @@ class Animation(object):
         self.name = ''
         self.length = 0
         self.looping = True
-        self.keyframes = []
+        self._keyframes = []
+        # sorted keyframe times parallel to self.keyframes
+        self._keyTimes = []
+        self._keyframeIdsValid = True
+        # index of the keyframe found by the last getKeyframeAt
+        self._cursor = 0
+        self._loader = None
+        self._changeListeners = []
+
+    @property
+    def keyframes(self):
+        self._load()
+        return self._keyframes
+
+    @property
+    def isLoaded(self):
+        return self._loader is None
+
+    def deferLoading(self, loader):
+        """
+        Postpones reading the keyframes of this animation until they are
+        first used, at which point loader(animation) is called to add them.
+        The id, name, length and looping attributes should already be set.
+        """
+        self._loader = loader
+
+    def _load(self):
+        if self._loader is not None:
+            loader = self._loader
+            self._loader = None
+            loader(self)
 
     def addKeyframe(self, keyframe):
-        newT = keyframe.time
-        prevFrame = None
-        for otherFrame in self.keyframes:
-            if otherFrame.time > newT:
-                break
-            prevFrame = otherFrame
-        if prevFrame:
-            keyframe.id = prevFrame.id + 1
-            prevFrame.length = keyframe.time - prevFrame.time
+        """
+        Inserts the keyframe after any keyframes with the same or an earlier
+        time. The time of a keyframe must not change while it is part of an
+        animation.
+        """
+        self._load()
+        index = bisect.bisect_right(self._keyTimes, keyframe.time)
+        self.keyframes.insert(index, keyframe)
+        self._keyTimes.insert(index, keyframe.time)
+        keyframe.animation = self
+        if index == len(self.keyframes) - 1:
+            keyframe.id = index
         else:
-            keyframe.id = 0
-        self.keyframes.insert(keyframe.id, keyframe)
+            self._keyframeIdsValid = False
+        if index > 0:
+            prevFrame = self.keyframes[index - 1]
+            prevFrame.length = keyframe.time - prevFrame.time
         # set length of new keyframe
-        nextIndex = keyframe.id + 1
-        if nextIndex < len(self.keyframes):
-            nextKeyframe = self.keyframes[nextIndex]
-            nextT = nextKeyframe.time
-            # update the ids of the other keyframes
-            while nextIndex < len(self.keyframes):
-                self.keyframes[nextIndex].id += 1
-                nextIndex += 1
+        if index + 1 < len(self.keyframes):
+            nextT = self._keyTimes[index + 1]
         else:
             nextT = self.length
         keyframe.length = nextT - keyframe.time
+        self._notifyChanged(self._spansAround(index))
 
     def removeKeyframe(self, keyframe):
-        prevKeyframe = self.getPrevKeyframe(keyframe, noLooping=True)
-        nextKeyframe = self.getNextKeyframe(keyframe, noLooping=True)
-        if prevKeyframe != keyframe:
-            if nextKeyframe != keyframe:
-                nextT = nextKeyframe.time
+        index = self._indexOf(keyframe)
+        spans = self._spansAround(index)
+        if index > 0:
+            prevKeyframe = self.keyframes[index - 1]
+            if index + 1 < len(self.keyframes):
+                nextT = self._keyTimes[index + 1]
             else:
                 nextT = self.length
             prevKeyframe.length = nextT - prevKeyframe.time
-        index = self.keyframes.index(keyframe)
-        self.keyframes.remove(keyframe)
-        while index < len(self.keyframes):
-            self.keyframes[index].id = index 
+        del self.keyframes[index]
+        del self._keyTimes[index]
+        keyframe.animation = None
+        self._keyframeIdsValid = False
+        self._notifyChanged(spans)
+
+    def keyframeChanged(self, keyframe):
+        """Call after changing the state of one of the keyframes in place."""
+        self._notifyChanged(self._spansAround(self._indexOf(keyframe)))
+
+    def addChangeListener(self, listener):
+        """
+        listener(animation, start, end) is called when the poses between the
+        times start (inclusive) and end (exclusive) may have changed.
+        """
+        self._changeListeners.append(listener)
+
+    def removeChangeListener(self, listener):
+        if listener in self._changeListeners:
+            self._changeListeners.remove(listener)
+
+    def _spansAround(self, index):
+        """The (start, end) time spans whose poses depend on a keyframe."""
+        times = self._keyTimes
+        start = times[index - 1] if index > 0 else 0
+        end = times[index + 1] if index + 1 < len(times) else self.length
+        spans = [(start, end)]
+        if self.looping and index == 0 and len(times) > 1:
+            # the last keyframe interpolates towards the first
+            spans.append((times[-1], self.length))
+        return spans
+
+    def _notifyChanged(self, spans):
+        for listener in list(self._changeListeners):
+            for start, end in spans:
+                listener(self, start, end)
+
+    def _indexOf(self, keyframe):
+        self._load()
+        index = bisect.bisect_left(self._keyTimes, keyframe.time)
+        while self.keyframes[index] is not keyframe:
             index += 1
+        return index
+
+    def _updateKeyframeIds(self):
+        """Keyframe ids are renumbered lazily after inserts and removals."""
+        if self._keyframeIdsValid:
+            return
+        self._keyframeIdsValid = True
+        for index, keyframe in enumerate(self.keyframes):
+            keyframe._id = index
 
     def getKeyframe(self, keyframeId):
         return self.keyframes[keyframeId]
 
     def getKeyframeAt(self, t):
-        result = None
-        for keyframe in self.keyframes:
-            if keyframe.time > t:
-                break
-            result = keyframe
-        return result
+        self._load()
+        times = self._keyTimes
+        count = len(times)
+        # try the last span and the one after it before searching
+        index = self._cursor
+        if not (index < count and times[index] <= t and
+                (index + 1 == count or t < times[index + 1])):
+            index += 1
+            if not (index < count and times[index] <= t and
+                    (index + 1 == count or t < times[index + 1])):
+                index = bisect.bisect_right(times, t) - 1
+        if index < 0:
+            return None
+        self._cursor = index
+        return self.keyframes[index]
 
     def getPrevKeyframe(self, keyframe, noLooping=False):
         looping = not noLooping and self.looping
-        prevId = keyframe.id - 1
+        prevId = self._indexOf(keyframe) - 1
         if prevId < 0:
             if looping:
                 prevId = len(self.keyframes) - 1
@@ -126,12 +216,13 @@ class Animation(object):
 
     def getNextKeyframe(self, keyframe, noLooping=False):
         looping = not noLooping and self.looping
-        nextId = keyframe.id + 1
+        keyframeId = self._indexOf(keyframe)
+        nextId = keyframeId + 1
         if nextId >= len(self.keyframes):
             if looping:
                 nextId = 0
             else:
-                nextId = keyframe.id
+                nextId = keyframeId
         return self.keyframes[nextId]
 
     def updateEntityState(self, state, t):
@@ -143,6 +234,45 @@ class Animation(object):
             relativeT = (t - key0.time) * key0.inverseLength
             state.interpolate(key0.entityState, key1.entityState, relativeT)
 
+    def sample(self, times, shortest=False):
+        """
+        Evaluates the animation at each of the given times in one call.
+        This is equivalent to calling updateEntityState and flatten for
+        every time, but the frames of each keyframe span are interpolated
+        together. Returns a PoseSamples.
+        """
+        times = numpy.asarray(times, dtype=numpy.float64)
+        keyframes = self.keyframes
+        keyTimes = numpy.array(self._keyTimes, dtype=numpy.float64)
+        inverseLengths = numpy.array([k.inverseLength for k in keyframes])
+        index0 = numpy.searchsorted(keyTimes, times, side='right') - 1
+        numpy.clip(index0, 0, None, out=index0)
+        index1 = index0 + 1
+        if self.looping:
+            index1[index1 == len(keyframes)] = 0
+        else:
+            index1[index1 == len(keyframes)] = len(keyframes) - 1
+        held = index0 == index1
+        relativeT = (times - keyTimes[index0]) * inverseLengths[index0]
+
+        samples = PoseSamples()
+        samples.times = times
+        layers = (
+            ('bones', [k.entityState.boneChannels for k in keyframes]),
+            ('skins', [k.entityState.skinChannels for k in keyframes]),
+        )
+        for attr, keyChannels in layers:
+            keyChannels = numpy.array(keyChannels)
+            channels = pose.interpolate(
+                keyChannels[index0], keyChannels[index1], relativeT, shortest)
+            channels[held] = keyChannels[index0[held]]
+            setattr(samples, attr, channels)
+        levels, skinParents = self.entityState.hierarchy()
+        samples.flatBones = pose.flattenBones(samples.bones, levels)
+        samples.flatSkins = pose.flattenSkins(
+            samples.skins, skinParents, samples.flatBones)
+        return samples
+
     def cloneEntityState(self):
         if self.keyframes:
             return self.keyframes[0].entityState.clone()
@@ -153,7 +283,33 @@ class Animation(object):
         if self.keyframes:
             return self.keyframes[0].entityState
         return None
-    
+
+    def compact(self):
+        """
+        Moves the channels of every keyframe into one (keyframes x objects x
+        channels) array for the bones and one for the skins, with each
+        keyframe's EntityState a view of its row. The states share a single
+        shape and topology and drop their Bone and Skin objects until they
+        are next used. Returns False, changing nothing, if the keyframes
+        differ in shape.
+        """
+        keyframes = self.keyframes
+        if not keyframes:
+            return True
+        firstState = keyframes[0].entityState
+        shape = firstState.shape
+        for keyframe in keyframes:
+            if keyframe.entityState.shape != shape:
+                return False
+        topology = firstState.topology()
+        bones = numpy.array([k.entityState.boneChannels for k in keyframes])
+        skins = numpy.array([k.entityState.skinChannels for k in keyframes])
+        for index, keyframe in enumerate(keyframes):
+            entityState = EntityState.fromChannels(shape, bones[index], skins[index])
+            entityState._topology = topology
+            keyframe.entityState = entityState
+        return True
+
     def clone(self):
         animation = Animation()
         animation.name = self.name
@@ -172,12 +328,24 @@ class Keyframe(object):
     Keyframe represents a pose at a specific time in an Animation.
     """
     def __init__(self, keyframeId, time, entityState):
+        self.animation = None
         self.id = keyframeId
         self.time = time
         self.spin = 0
         self.length = 0.0
         self.entityState = entityState
 
+    @property
+    def id(self):
+        """The index of this keyframe in its animation."""
+        if self.animation is not None:
+            self.animation._updateKeyframeIds()
+        return self._id
+
+    @id.setter
+    def id(self, val):
+        self._id = val
+
     @property
     def length(self):
         return self._length
@@ -197,87 +365,370 @@ class Keyframe(object):
         return keyframe
 
 
+class PoseSamples(object):
+    """
+    The result of Animation.sample. Each of the channel arrays has the shape
+    (frames x objects x channels) using the channel layout of models.pose;
+    bones and skins are local transforms while flatBones and flatSkins are
+    the flattened (world) transforms.
+    """
+    def __init__(self):
+        self.times = None
+        self.bones = None
+        self.skins = None
+        self.flatBones = None
+        self.flatSkins = None
+
+    def __len__(self):
+        return len(self.times)
+
+
 class EntityState(object):
     """
     EntityState describes the orientation of a skeleton and its skin.
+    The transforms of the bones and skins are views over two channel arrays
+    (see models.pose) which the bulk operations below work on directly.
+    All of the states passed to these operations are expected to have the
+    same shape, e.g. states from the keyframes of a single AnimationSet.
+
+    Clones are copy-on-write: a clone shares the channel arrays of its
+    source until either of them is written to, and only creates its Bone and
+    Skin objects when they are first accessed.
     """
+    __slots__ = (
+        '_bones', '_skins', '_boneByName', '_skinByName', '_boneCount',
+        '_skinCount', '_shape', '_boneData', '_skinData', '_topology',
+        '_dirtyBones', '_dirtySkins', '_flattenedInto', '_flattenedFrom'
+    )
+
     def __init__(self):
-        self.skins = []
-        self.bones = []
-        self.skinByName = {}
-        self.boneByName = {}
+        self._bones = []
+        self._skins = []
+        self._boneByName = {}
+        self._skinByName = {}
+        self._boneCount = 0
+        self._skinCount = 0
+        # names and parents of the bones and skins, captured for clones
+        self._shape = None
+        self._boneData = numpy.empty((0, pose.TRANSFORM_CHANNELS))
+        self._skinData = numpy.empty((0, pose.SKIN_CHANNELS))
+        self._topology = None
+        # ids of the bones and skins written since the last flatten of this
+        # state, None if they aren't known; see flatten
+        self._dirtyBones = None
+        self._dirtySkins = None
+        # the state this one was last flattened into, and the state it
+        # holds the flattened channels of
+        self._flattenedInto = None
+        self._flattenedFrom = None
+
+    @property
+    def bones(self):
+        self._materialize()
+        return self._bones
+
+    @property
+    def skins(self):
+        self._materialize()
+        return self._skins
+
+    @property
+    def boneByName(self):
+        self._materialize()
+        return self._boneByName
+
+    @property
+    def skinByName(self):
+        self._materialize()
+        return self._skinByName
+
+    @property
+    def boneChannels(self):
+        """
+        (bones x channels) array backing the bone transforms.
+        It is read-only while it is shared with a clone.
+        """
+        return self._boneData[:self._boneCount]
+
+    @property
+    def skinChannels(self):
+        """
+        (skins x channels) array backing the skin transforms.
+        It is read-only while it is shared with a clone.
+        """
+        return self._skinData[:self._skinCount]
+
+    def _writableBoneChannels(self):
+        self._detach()
+        self._dirtyBones = None
+        self._flattenedFrom = None
+        return self._boneData[:self._boneCount]
+
+    def _writableSkinChannels(self):
+        self._detach()
+        self._dirtySkins = None
+        self._flattenedFrom = None
+        return self._skinData[:self._skinCount]
+
+    def _channelsWritten(self, channels):
+        """Marks the bone or skin whose row of channels is being written."""
+        self._flattenedFrom = None
+        address = channels.__array_interface__['data'][0]
+        for data, dirty in ((self._boneData, self._dirtyBones),
+                            (self._skinData, self._dirtySkins)):
+            offset = address - data.__array_interface__['data'][0]
+            if 0 <= offset < data.nbytes:
+                if dirty is not None:
+                    dirty.add(offset // data.strides[0])
+                return
 
     def addBone(self, bone, boneId=-1):
+        bones = self.bones
+        self._detach()
         if boneId == -1:
-            bone.id = len(self.bones)
+            bone.id = len(bones)
         else:
             bone.id = boneId
-        while len(self.bones) <= bone.id:
-            self.bones.append(None)
-        self.bones[bone.id] = bone
+        while len(bones) <= bone.id:
+            bones.append(None)
+        self._boneCount = len(bones)
+        self._boneData = self._reserve(
+            self._boneData, bones, pose.TRANSFORM_DEFAULTS)
+        bones[bone.id] = bone
+        bone.bindChannels(self._boneData[bone.id], self)
         if bone.name != '':
-            self.boneByName[bone.name] = bone
+            self._boneByName[bone.name] = bone
+        self._shape = None
+        self._topology = None
+        self._dirtyBones = None
+        self._flattenedFrom = None
 
     def addSkin(self, skin):
-        skin.id = len(self.skins)
-        self.skins.append(skin)
+        skins = self.skins
+        self._detach()
+        skin.id = len(skins)
+        skins.append(skin)
+        self._skinCount = len(skins)
+        self._skinData = self._reserve(
+            self._skinData, skins, pose.SKIN_DEFAULTS)
+        skin.bindChannels(self._skinData[skin.id], self)
         if skin.name != '':
-            self.skinByName[skin.name] = skin
+            self._skinByName[skin.name] = skin
+        self._shape = None
+        self._topology = None
+        self._dirtySkins = None
+        self._flattenedFrom = None
+
+    def _reserve(self, data, objects, defaults):
+        newData = pose.reserveChannels(data, len(objects), defaults)
+        if newData is not data:
+            for i, obj in enumerate(objects):
+                if obj is not None:
+                    obj.bindChannels(newData[i], self)
+        return newData
+
+    def _attachObjects(self, objects, data):
+        if objects is None:
+            return
+        for i, obj in enumerate(objects):
+            if obj is not None:
+                obj.attachChannels(data[i], self)
+
+    def _share(self):
+        """Makes the channel arrays read-only so they can be shared."""
+        if self._boneData.flags.writeable:
+            self._boneData.flags.writeable = False
+            self._attachObjects(self._bones, self._boneData)
+        if self._skinData.flags.writeable:
+            self._skinData.flags.writeable = False
+            self._attachObjects(self._skins, self._skinData)
+
+    def _detach(self):
+        """Takes private copies of any channel arrays that are shared."""
+        if not self._boneData.flags.writeable:
+            self._boneData = self._boneData.copy()
+            self._attachObjects(self._bones, self._boneData)
+        if not self._skinData.flags.writeable:
+            self._skinData = self._skinData.copy()
+            self._attachObjects(self._skins, self._skinData)
+
+    def _getShape(self):
+        if self._shape is None:
+            boneShape = tuple(
+                None if bone is None else (bone.name, bone.parent)
+                for bone in self._bones
+            )
+            skinShape = tuple((skin.name, skin.parent) for skin in self._skins)
+            self._shape = (boneShape, skinShape)
+        return self._shape
+
+    def _materialize(self):
+        """Creates the Bone and Skin views of a cloned state."""
+        if self._bones is not None:
+            return
+        boneShape, skinShape = self._shape
+        bones = []
+        boneByName = {}
+        for boneId, boneMeta in enumerate(boneShape):
+            if boneMeta is None:
+                bones.append(None)
+                continue
+            bone = Bone()
+            bone.id = boneId
+            bone.name, bone.parent = boneMeta
+            bone.attachChannels(self._boneData[boneId], self)
+            bones.append(bone)
+            if bone.name != '':
+                boneByName[bone.name] = bone
+        skins = []
+        skinByName = {}
+        for skinId, skinMeta in enumerate(skinShape):
+            skin = Skin()
+            skin.id = skinId
+            skin.name, skin.parent = skinMeta
+            skin.attachChannels(self._skinData[skinId], self)
+            skins.append(skin)
+            if skin.name != '':
+                skinByName[skin.name] = skin
+        self._bones, self._skins = bones, skins
+        self._boneByName, self._skinByName = boneByName, skinByName
 
     def rootBone(self):
         if self.bones:
             return self.bones[0]
         return None
 
+    @classmethod
+    def fromChannels(cls, shape, boneChannels, skinChannels):
+        """
+        Creates a state which uses the given channel arrays without copying
+        them, e.g. arrays mapped from a cache file. `shape` is the
+        (boneShape, skinShape) pair described by EntityState.shape. Read-only
+        arrays are copied on the first write.
+        """
+        state = cls()
+        state._bones = state._skins = None
+        state._boneByName = state._skinByName = None
+        state._shape = shape
+        state._boneData = boneChannels
+        state._skinData = skinChannels
+        state._boneCount = len(boneChannels)
+        state._skinCount = len(skinChannels)
+        return state
+
+    @property
+    def shape(self):
+        """
+        A (boneShape, skinShape) pair of tuples with the (name, parent) of
+        each bone and skin. Missing bone ids are None.
+        """
+        return self._getShape()
+
     def clone(self):
-        state = EntityState()
-        for bone in self.bones:
-            newBone = bone.clone()
-            state.addBone(newBone)
-        for skin in self.skins:
-            newSkin = skin.clone()
-            state.addSkin(newSkin)
+        self._share()
+        state = EntityState.fromChannels(
+            self._getShape(), self.boneChannels, self.skinChannels)
+        state._topology = self._topology
         return state
 
     def copy(self, other):
-        for thisBone, otherBone in zip(self.bones, other.bones):
-            thisBone.copy(otherBone)
-        for thisSkin, otherSkin in zip(self.skins, other.skins):
-            thisSkin.copy(otherSkin)
+        self.setChannels(other.boneChannels, other.skinChannels)
+
+    def setChannels(self, boneChannels, skinChannels):
+        """Copies the given channel arrays into this state."""
+        self._writableBoneChannels()[:] = boneChannels
+        self._writableSkinChannels()[:] = skinChannels
 
     def interpolate(self, state0, state1, t, shortest=False):
-        for thisBone, state0Bone, state1Bone in zip(self.bones, state0.bones, state1.bones):
-            thisBone.interpolate(state0Bone, state1Bone, t, shortest)
-        for thisSkin, state0Skin, state1Skin in zip(self.skins, state0.skins, state1.skins):
-            thisSkin.interpolate(state0Skin, state1Skin, t, shortest)
+        pose.interpolate(state0.boneChannels, state1.boneChannels, t, shortest,
+            out=self._writableBoneChannels())
+        pose.interpolate(state0.skinChannels, state1.skinChannels, t, shortest,
+            out=self._writableSkinChannels())
 
     def combineSelf(self, state0, shortest=False):
         self.combine(self, state0, shortest)
 
     def combine(self, state0, state1, shortest=False):
-        for thisBone, state0Bone, state1Bone in zip(self.bones, state0.bones, state1.bones):
-            thisBone.combine(state0Bone, state1Bone, shortest)
-        for thisSkin, state0Skin, state1Skin in zip(self.skins, state0.skins, state1.skins):
-            thisSkin.combine(state0Skin, state1Skin, shortest)
+        pose.combine(
+            state0.boneChannels, state1.boneChannels, self._writableBoneChannels())
+        pose.combine(
+            state0.skinChannels, state1.skinChannels, self._writableSkinChannels())
 
     def difference(self, state0, state1, shortest=False):
-        for thisBone, state0Bone, state1Bone in zip(self.bones, state0.bones, state1.bones):
-            thisBone.difference(state0Bone, state1Bone, shortest)
-        for thisSkin, state0Skin, state1Skin in zip(self.skins, state0.skins, state1.skins):
-            thisSkin.difference(state0Skin, state1Skin, shortest)
+        pose.difference(
+            state0.boneChannels, state1.boneChannels, self._writableBoneChannels())
+        pose.difference(
+            state0.skinChannels, state1.skinChannels, self._writableSkinChannels())
+
+    def topology(self):
+        """
+        Returns the pose.Topology of this state's bones and skins. It is
+        computed when first needed, shared with clones and only rebuilt
+        after addBone or addSkin.
+        """
+        if self._topology is None:
+            self._topology = pose.Topology(*self._getShape())
+        return self._topology
+
+    def hierarchy(self):
+        """
+        Returns the hierarchy levels of the bones (see pose.hierarchyLevels)
+        and the parent bone index of each skin.
+        """
+        topology = self.topology()
+        return topology.levels, topology.skinParents
+
+    def findBone(self, name):
+        """Returns the bone with the given name or None."""
+        boneId = self.topology().boneIds.get(name, -1)
+        if boneId == -1:
+            return None
+        return self.bones[boneId]
+
+    def findSkinsOfBone(self, bone):
+        """Returns the skins attached to a bone."""
+        skins = self.skins
+        return [skins[skinId] for skinId in self.topology().boneSkins.get(bone.id, ())]
 
     def flatten(self, targetState):
         """
         NOTE: Unlike many of the other methods on EntityState, flatten uses 
         the targetState parameter as an output.
+
+        Writes to the transforms of bones and skins are tracked, so
+        flattening into the same target again only recomputes the bones
+        written since then, their descendants and the skins attached to
+        them; nothing is recomputed if nothing was written. Bulk writes such
+        as interpolate, and writes to the target, make it start over.
         """
-        for thisBone, targetBone in zip(self.bones, targetState.bones):
-            targetBone.copy(thisBone)
-            if targetBone.parent != -1:
-                parent = targetState.bones[targetBone.parent]
-                targetBone.transform.applyTransform(parent.transform)
-        for thisSkin, targetSkin in zip(self.skins, targetState.skins):
-            targetSkin.copy(thisSkin)
-            if targetSkin.parent != -1:
-                parent = targetState.bones[targetSkin.parent]
-                targetSkin.transform.applyTransform(parent.transform)
+        topology = self.topology()
+        levels, skinParents = topology.levels, topology.skinParents
+        dirtyBoneIds, dirtySkinIds = self._dirtyBones, self._dirtySkins
+        if (targetState._flattenedFrom is not self or self._flattenedInto is not targetState
+                or dirtyBoneIds is None or dirtySkinIds is None):
+            boneChannels = self.boneChannels
+            worldBones = targetState._writableBoneChannels()
+            pose.flattenBones(boneChannels, levels, out=worldBones)
+            pose.flattenSkins(
+                self.skinChannels, skinParents, worldBones,
+                out=targetState._writableSkinChannels())
+        elif dirtyBoneIds or dirtySkinIds:
+            dirtyBones = numpy.zeros(self._boneCount, dtype=bool)
+            for boneId in dirtyBoneIds:
+                position = topology.position[boneId]
+                dirtyBones[topology.order[position:topology.subtreeEnd[boneId]]] = True
+            dirtySkins = numpy.zeros(self._skinCount, dtype=bool)
+            dirtySkins[list(dirtySkinIds)] = True
+            if len(dirtyBones):
+                dirtySkins |= (skinParents >= 0) & dirtyBones[skinParents]
+            worldBones = targetState._writableBoneChannels()
+            if dirtyBones.any():
+                pose.reflattenBones(self.boneChannels, levels, dirtyBones, worldBones)
+            if dirtySkins.any():
+                pose.reflattenSkins(
+                    self.skinChannels, skinParents, worldBones, dirtySkins,
+                    targetState._writableSkinChannels())
+        self._dirtyBones = set()
+        self._dirtySkins = set()
+        self._flattenedInto = targetState
+        targetState._flattenedFrom = self
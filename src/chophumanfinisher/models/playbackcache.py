@@ -0,0 +1,153 @@
+"""
+A cache of baked animation frames for previewing.
+"""
+from collections import OrderedDict
+import numpy
+
+
+class BakedAnimation(object):
+    """
+    The local and flattened channels of every integer frame of an animation.
+    Frames are filled in a keyframe span at a time as they are requested,
+    except for frames invalidated by an edit: those are filled one at a
+    time, so that editing doesn't rebake a span per change.
+    """
+    def __init__(self, animation):
+        entityState = animation.entityState
+        frameCount = max(int(animation.length), 1)
+        boneShape = (frameCount,) + entityState.boneChannels.shape
+        skinShape = (frameCount,) + entityState.skinChannels.shape
+        self.shape = entityState.shape
+        self.bones = numpy.empty(boneShape)
+        self.skins = numpy.empty(skinShape)
+        self.flatBones = numpy.empty(boneShape)
+        self.flatSkins = numpy.empty(skinShape)
+        self.filled = numpy.zeros(frameCount, dtype=bool)
+        self.stale = numpy.zeros(frameCount, dtype=bool)
+
+    @staticmethod
+    def estimateBytes(animation):
+        entityState = animation.entityState
+        frameSize = entityState.boneChannels.size + entityState.skinChannels.size
+        return 2 * max(int(animation.length), 1) * frameSize * 8
+
+    @property
+    def nbytes(self):
+        return (self.bones.nbytes + self.skins.nbytes +
+                self.flatBones.nbytes + self.flatSkins.nbytes)
+
+    def fill(self, animation, frame):
+        """Bakes the frames of the keyframe span containing frame."""
+        keyframe = animation.getKeyframeAt(frame)
+        if keyframe is None:
+            start = 0
+            keyframe = animation.keyframes[0]
+        else:
+            start = keyframe.time
+        nextKeyframe = animation.getNextKeyframe(keyframe, noLooping=True)
+        if nextKeyframe is keyframe:
+            end = len(self.filled)
+        else:
+            end = nextKeyframe.time
+        start = max(0, min(start, frame))
+        end = min(len(self.filled), max(end, frame + 1))
+        frames = numpy.arange(start, end)
+        samples = animation.sample(frames)
+        self.bones[start:end] = samples.bones
+        self.skins[start:end] = samples.skins
+        self.flatBones[start:end] = samples.flatBones
+        self.flatSkins[start:end] = samples.flatSkins
+        self.filled[start:end] = True
+        self.stale[start:end] = False
+
+    def fillFrame(self, animation, frame, entityState, flatEntityState):
+        """Bakes a single frame, leaving it in the given states."""
+        animation.updateEntityState(entityState, frame)
+        entityState.flatten(flatEntityState)
+        self.bones[frame] = entityState.boneChannels
+        self.skins[frame] = entityState.skinChannels
+        self.flatBones[frame] = flatEntityState.boneChannels
+        self.flatSkins[frame] = flatEntityState.skinChannels
+        self.filled[frame] = True
+        self.stale[frame] = False
+
+    def invalidate(self, start, end):
+        span = slice(max(0, int(start)), max(0, int(numpy.ceil(end))))
+        self.stale[span] |= self.filled[span]
+        self.filled[span] = False
+
+
+class PlaybackCache(object):
+    """
+    Baked frames of the most recently played animations, so that showing a
+    frame a second time is a table lookup instead of an interpolation and a
+    flatten. The least recently used animations are dropped to keep the
+    cache under maxBytes. Animations report their own keyframe edits (see
+    Animation.addChangeListener) and only the affected spans are rebaked;
+    call invalidate after other changes such as a new length.
+    """
+    def __init__(self, maxBytes=64 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self._baked = OrderedDict()
+
+    @property
+    def nbytes(self):
+        return sum(baked.nbytes for baked in self._baked.values())
+
+    def updateEntityState(self, animation, frame, entityState, flatEntityState):
+        """
+        Sets the states to the given frame of the animation, like
+        Animation.updateEntityState followed by EntityState.flatten. Returns
+        False, leaving the states alone, if the frame can't be cached.
+        """
+        frame = int(frame)
+        baked = self._getBaked(animation)
+        if (baked is None or not 0 <= frame < len(baked.filled)
+                or entityState.shape != baked.shape):
+            return False
+        if baked.stale[frame]:
+            baked.fillFrame(animation, frame, entityState, flatEntityState)
+            return True
+        if not baked.filled[frame]:
+            baked.fill(animation, frame)
+        entityState.setChannels(baked.bones[frame], baked.skins[frame])
+        flatEntityState.setChannels(baked.flatBones[frame], baked.flatSkins[frame])
+        return True
+
+    def invalidate(self, animation=None, start=None, end=None):
+        """
+        Drops the baked frames from start to end of an animation; all of its
+        frames if no span is given and those of every animation if no
+        animation is given.
+        """
+        if animation is None:
+            for animation in list(self._baked):
+                self._remove(animation)
+        elif animation in self._baked:
+            if start is None:
+                self._remove(animation)
+            else:
+                self._baked[animation].invalidate(start, end)
+
+    def _onAnimationChanged(self, animation, start, end):
+        self.invalidate(animation, start, end)
+
+    def _getBaked(self, animation):
+        baked = self._baked.pop(animation, None)
+        if baked is None:
+            if not animation.keyframes:
+                return None
+            nbytes = BakedAnimation.estimateBytes(animation)
+            if nbytes > self.maxBytes:
+                return None
+            while self._baked and self.nbytes + nbytes > self.maxBytes:
+                self._remove(next(iter(self._baked)))
+            baked = BakedAnimation(animation)
+            animation.addChangeListener(self._onAnimationChanged)
+        # most recently used last
+        self._baked[animation] = baked
+        return baked
+
+    def _remove(self, animation):
+        del self._baked[animation]
+        animation.removeChangeListener(self._onAnimationChanged)
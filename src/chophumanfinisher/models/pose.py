@@ -0,0 +1,298 @@
+"""
+Structure-of-arrays pose math.
+A pose is a float array whose last axis holds the channels of a single bone
+or skin. Any number of leading axes are allowed so that the same functions
+evaluate one EntityState or a whole batch of frames at once.
+"""
+import numpy
+
+
+# transform channels (shared by bones and skins)
+X, Y, ANGLE, SCALE_X, SCALE_Y, SPIN = range(6)
+# skin-only channels
+PIVOT_X, PIVOT_Y, OPACITY, Z_INDEX = range(6, 10)
+
+TRANSFORM_CHANNELS = 6
+SKIN_CHANNELS = 10
+
+TRANSFORM_DEFAULTS = (0.0, 0.0, 0.0, 1.0, 1.0, 0.0)
+SKIN_DEFAULTS = TRANSFORM_DEFAULTS + (0.0, 0.0, 1.0, 0.0)
+
+FULL_CIRCLE = 360.0
+HALF_CIRCLE = 180.0
+
+
+def newChannels(defaults):
+    return numpy.array(defaults, dtype=numpy.float64)
+
+
+def reserveChannels(channels, count, defaults):
+    """
+    Returns an array with room for at least `count` rows. If `channels` is
+    too small, a larger copy is made and the new rows are set to `defaults`.
+    """
+    capacity = len(channels)
+    if count <= capacity:
+        return channels
+    capacity = max(count, 2 * capacity, 4)
+    grown = numpy.empty((capacity, len(defaults)), dtype=numpy.float64)
+    grown[:len(channels)] = channels
+    grown[len(channels):] = defaults
+    return grown
+
+
+def normalizeAngles(angles, out=None):
+    return numpy.mod(angles, FULL_CIRCLE, out)
+
+
+def lerpAngles(a0, a1, t, spin):
+    """
+    Spin > 0 always turns counter-clockwise, spin < 0 clockwise and
+    spin == 0 takes the shortest arc.
+    """
+    delta = a1 - a0
+    shortest = numpy.where(
+        delta > HALF_CIRCLE, delta - FULL_CIRCLE,
+        numpy.where(delta < -HALF_CIRCLE, delta + FULL_CIRCLE, delta)
+    )
+    delta = numpy.where(
+        spin > 0, numpy.where(a0 > a1, delta + FULL_CIRCLE, delta),
+        numpy.where(
+            spin < 0, numpy.where(a0 < a1, delta - FULL_CIRCLE, delta),
+            shortest
+        )
+    )
+    return a0 + t * delta
+
+
+def interpolate(channels0, channels1, t, shortest=False, out=None):
+    """
+    Vectorized version of Transform/Skin.interpolate. `t` is either a scalar
+    or an array which is broadcast against the leading axes of the channels,
+    e.g. shape (frames,) for channels of shape (frames, objects, channels).
+    """
+    t = numpy.asarray(t, dtype=numpy.float64)
+    result = channels0 + t.reshape(t.shape + (1, 1)) * (channels1 - channels0)
+    if shortest:
+        result[..., SPIN] = 0.0
+    else:
+        result[..., SPIN] = channels0[..., SPIN]
+    result[..., ANGLE] = normalizeAngles(lerpAngles(
+        channels0[..., ANGLE], channels1[..., ANGLE],
+        t.reshape(t.shape + (1,)), result[..., SPIN]
+    ))
+    if result.shape[-1] > Z_INDEX:
+        result[..., Z_INDEX] = channels0[..., Z_INDEX]
+    if out is None:
+        return result
+    out[...] = result
+    return out
+
+
+def combine(channels0, channels1, out):
+    """Vectorized version of SceneObject.combine."""
+    zIndex = None
+    if out.shape[-1] > Z_INDEX:
+        zIndex = out[..., Z_INDEX].copy()
+    numpy.add(channels0, channels1, out)
+    normalizeAngles(out[..., ANGLE], out[..., ANGLE])
+    out[..., SPIN] = 0.0
+    if zIndex is not None:
+        out[..., Z_INDEX] = zIndex
+    return out
+
+
+def difference(channels0, channels1, out):
+    """Vectorized version of SceneObject.difference."""
+    zIndex = None
+    if out.shape[-1] > Z_INDEX:
+        zIndex = out[..., Z_INDEX].copy()
+    numpy.subtract(channels1, channels0, out)
+    normalizeAngles(out[..., ANGLE], out[..., ANGLE])
+    out[..., SPIN] = 0.0
+    if zIndex is not None:
+        out[..., Z_INDEX] = zIndex
+    return out
+
+
+def applyParent(channels, parentChannels, out=None):
+    """
+    Vectorized version of Transform.applyTransform: moves `channels` from the
+    space of `parentChannels` into the parent's space.
+    """
+    if out is None:
+        out = channels.copy()
+    elif out is not channels:
+        out[...] = channels
+    parentAngle = parentChannels[..., ANGLE]
+    radians = numpy.radians(parentAngle)
+    pc = numpy.cos(radians)
+    ps = numpy.sin(radians)
+    x = channels[..., X] * parentChannels[..., SCALE_X]
+    y = channels[..., Y] * parentChannels[..., SCALE_Y]
+    out[..., X] = parentChannels[..., X] + x * pc - y * ps
+    out[..., Y] = parentChannels[..., Y] + x * ps + y * pc
+    out[..., ANGLE] = channels[..., ANGLE] + normalizeAngles(parentAngle)
+    out[..., SCALE_X] = channels[..., SCALE_X] * parentChannels[..., SCALE_X]
+    out[..., SCALE_Y] = channels[..., SCALE_Y] * parentChannels[..., SCALE_Y]
+    return out
+
+
+def hierarchyLevels(parents):
+    """
+    Groups the bones by their depth in the hierarchy so that forward
+    kinematics can be evaluated one level at a time, regardless of the order
+    of the bones. Returns a list of (indices, parentIndices) array pairs,
+    starting with the children of the roots.
+    """
+    parents = numpy.asarray(parents, dtype=numpy.intp)
+    if (parents >= len(parents)).any():
+        raise ValueError('Bone hierarchy contains a missing parent')
+    depth = numpy.where(parents < 0, 0, -1)
+    current = 0
+    while (depth < 0).any():
+        isNext = (depth < 0) & (parents >= 0)
+        isNext &= depth[numpy.clip(parents, 0, None)] == current
+        if not isNext.any():
+            raise ValueError('Bone hierarchy contains a cycle')
+        current += 1
+        depth[isNext] = current
+    levels = []
+    for level in range(1, current + 1):
+        indices = numpy.flatnonzero(depth == level)
+        levels.append((indices, parents[indices]))
+    return levels
+
+
+class Topology(object):
+    """
+    The structure of a skeleton, computed once from the names and parents of
+    its bones and skins:
+
+    parents         parent bone index of each bone, -1 for roots and for
+                    missing bone ids
+    levels          see hierarchyLevels
+    order           the bones in depth-first order; every bone comes after
+                    its parent and each subtree is contiguous
+    position        index of each bone in order (-1 for missing ids)
+    subtreeEnd      the subtree of bone b is order[position[b]:subtreeEnd[b]]
+    skinParents     parent bone index of each skin
+    boneIds         bone name -> bone index
+    skinIds         skin name -> skin index
+    boneSkins       bone index -> indices of the skins attached to it
+    """
+    def __init__(self, boneShape, skinShape):
+        count = len(boneShape)
+        self.parents = numpy.array(
+            [-1 if meta is None else meta[1] for meta in boneShape], dtype=numpy.intp)
+        self.levels = hierarchyLevels(self.parents)
+        children = [[] for _ in range(count)]
+        roots = []
+        for boneId, meta in enumerate(boneShape):
+            if meta is None:
+                continue
+            if meta[1] < 0:
+                roots.append(boneId)
+            else:
+                children[meta[1]].append(boneId)
+        order = []
+        position = numpy.empty(count, dtype=numpy.intp)
+        position.fill(-1)
+        subtreeEnd = position.copy()
+        stack = [(boneId, False) for boneId in reversed(roots)]
+        while stack:
+            boneId, finished = stack.pop()
+            if finished:
+                subtreeEnd[boneId] = len(order)
+                continue
+            position[boneId] = len(order)
+            order.append(boneId)
+            stack.append((boneId, True))
+            stack.extend((child, False) for child in reversed(children[boneId]))
+        self.order = numpy.array(order, dtype=numpy.intp)
+        self.position = position
+        self.subtreeEnd = subtreeEnd
+        self.skinParents = numpy.array(
+            [meta[1] for meta in skinShape], dtype=numpy.intp)
+        self.boneIds = {}
+        for boneId, meta in enumerate(boneShape):
+            if meta is not None and meta[0] != '':
+                self.boneIds.setdefault(meta[0], boneId)
+        self.skinIds = {}
+        self.boneSkins = {}
+        for skinId, (name, parent) in enumerate(skinShape):
+            if name != '':
+                self.skinIds.setdefault(name, skinId)
+            self.boneSkins.setdefault(parent, []).append(skinId)
+
+    def subtree(self, boneId):
+        """The indices of a bone and all of its descendants, parents first."""
+        return self.order[self.position[boneId]:self.subtreeEnd[boneId]]
+
+
+def flattenBones(channels, levels, out=None):
+    """
+    Forward kinematics: converts local bone channels to world channels.
+    """
+    if out is None:
+        out = channels.copy()
+    elif out is not channels:
+        out[...] = channels
+    for indices, parentIndices in levels:
+        out[..., indices, :] = applyParent(
+            out[..., indices, :], out[..., parentIndices, :]
+        )
+    return out
+
+
+def flattenSkins(channels, skinParents, worldBoneChannels, out=None):
+    """
+    Places skins in world space using the already flattened bones.
+    `skinParents` is an array of bone indices with -1 for unparented skins.
+    """
+    if out is None:
+        out = channels.copy()
+    elif out is not channels:
+        out[...] = channels
+    indices = numpy.flatnonzero(skinParents >= 0)
+    if len(indices):
+        out[..., indices, :] = applyParent(
+            out[..., indices, :], worldBoneChannels[..., skinParents[indices], :]
+        )
+    return out
+
+
+def propagateDirty(dirty, levels):
+    """
+    Flags the descendants of the bones flagged in the boolean array `dirty`.
+    """
+    for indices, parentIndices in levels:
+        dirty[indices] |= dirty[parentIndices]
+    return dirty
+
+
+def reflattenBones(channels, levels, dirty, out):
+    """
+    Like flattenBones for a single pose, but `out` already holds the world
+    channels of the previous pose and only the bones flagged in `dirty`
+    (see propagateDirty) are recomputed. Levels without dirty bones are
+    skipped entirely.
+    """
+    out[dirty] = channels[dirty]
+    for indices, parentIndices in levels:
+        selected = dirty[indices]
+        if not selected.any():
+            continue
+        indices = indices[selected]
+        out[indices] = applyParent(out[indices], out[parentIndices[selected]])
+    return out
+
+
+def reflattenSkins(channels, skinParents, worldBoneChannels, dirty, out):
+    """Like flattenSkins, only recomputing the skins flagged in `dirty`."""
+    out[dirty] = channels[dirty]
+    indices = numpy.flatnonzero(dirty & (skinParents >= 0))
+    if len(indices):
+        out[indices] = applyParent(
+            out[indices], worldBoneChannels[skinParents[indices]])
+    return out
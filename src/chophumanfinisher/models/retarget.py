@@ -0,0 +1,228 @@
+"""
+Retargeting: correcting animations made for one rest pose so that they fit
+another.
+
+RetargetLayer applies the correction within a single AnimationSet, whose
+'rest' animation holds the original rest pose followed by the new one.
+RetargetLibrary maps a library of animations made for one rig onto other
+rigs. In both cases the difference between the rest poses is added to every
+keyframe, with the keyframes of each animation stacked into one array so
+that this is a handful of array operations per animation however many
+keyframes there are.
+"""
+import weakref
+import numpy
+from . import pose
+from .animation import AnimationSet, Animation, Keyframe, EntityState
+
+
+class RetargetLayer(object):
+    """
+    Keeps an AnimationSet retargeted to the second keyframe of its rest
+    animation. The first keyframe of the rest animation is the original
+    pose the other animations were made for.
+
+    The layer holds on to the original (base) channels of every keyframe
+    and replaces the keyframe's EntityState with a read-only derived state,
+    base + delta. Derived states are never written to, so a keyframe whose
+    EntityState was edited or replaced since the last update is detected
+    by it no longer using the derived arrays (see EntityState._detach); its
+    base is then recovered by subtracting the delta it was derived with.
+    update only recomputes keyframes that are new or were edited, unless the
+    rest pose changed, and is idempotent.
+    """
+    def __init__(self, animationSet, restName='rest'):
+        self.animationSet = animationSet
+        self.restName = restName
+        self._delta = None
+        # keyframe -> (baseBones, baseSkins, derivedState, derivedData)
+        self._records = weakref.WeakKeyDictionary()
+
+    def update(self):
+        """
+        Brings the keyframes up to date with the rest pose. Returns False if
+        the set doesn't have a rest animation with two keyframes.
+        """
+        restAnimation = self.animationSet.animationByName.get(self.restName, None)
+        if not restAnimation or len(restAnimation.keyframes) < 2:
+            return False
+        restKeyframe, targetKeyframe = restAnimation.keyframes[:2]
+        keyframeGroups = []
+        changed = set()
+        for animation in self.animationSet.animations:
+            if animation is restAnimation:
+                keyframes = [restKeyframe]
+            else:
+                keyframes = animation.keyframes
+            keyframeGroups.append(keyframes)
+            changed.update(k for k in keyframes if self._refreshBase(k))
+        baseBones, baseSkins = self._records[restKeyframe][:2]
+        targetState = targetKeyframe.entityState
+        delta = (
+            pose.difference(baseBones, targetState.boneChannels,
+                numpy.empty_like(targetState.boneChannels)),
+            pose.difference(baseSkins, targetState.skinChannels,
+                numpy.empty_like(targetState.skinChannels)),
+        )
+        restChanged = self._delta is None or not (
+            numpy.array_equal(delta[0], self._delta[0]) and
+            numpy.array_equal(delta[1], self._delta[1]))
+        self._delta = delta
+        for keyframes in keyframeGroups:
+            if not restChanged:
+                keyframes = [k for k in keyframes if k in changed]
+            if keyframes:
+                self._apply(keyframes)
+        return True
+
+    def restore(self):
+        """Puts the base states back on the keyframes and forgets them."""
+        for keyframe, record in list(self._records.items()):
+            baseBones, baseSkins, derived = record[:3]
+            keyframe.entityState = EntityState.fromChannels(
+                derived.shape, baseBones, baseSkins)
+        self._records.clear()
+        self._delta = None
+
+    def _refreshBase(self, keyframe):
+        """
+        Records the base channels of a keyframe which is new or was changed
+        since it was last derived. Returns True if the keyframe needs to be
+        derived again.
+        """
+        state = keyframe.entityState
+        record = self._records.get(keyframe)
+        if record is not None:
+            derived, (derivedBones, derivedSkins) = record[2:]
+            if (state is derived and state._boneData is derivedBones
+                    and state._skinData is derivedSkins):
+                return False
+        if self._delta is None:
+            # the first update: the keyframes hold base poses
+            state._share()
+            baseBones, baseSkins = state.boneChannels, state.skinChannels
+        else:
+            # otherwise they were made or edited in the retargeted space
+            baseBones = pose.difference(
+                self._delta[0], state.boneChannels, state.boneChannels.copy())
+            baseSkins = pose.difference(
+                self._delta[1], state.skinChannels, state.skinChannels.copy())
+        self._records[keyframe] = (baseBones, baseSkins, state, (None, None))
+        return True
+
+    def _apply(self, keyframes):
+        deltaBones, deltaSkins = self._delta
+        shape = keyframes[0].entityState.shape
+        bones = numpy.array([self._records[k][0] for k in keyframes])
+        skins = numpy.array([self._records[k][1] for k in keyframes])
+        pose.combine(bones, deltaBones, bones)
+        pose.combine(skins, deltaSkins, skins)
+        for index, keyframe in enumerate(keyframes):
+            derived = EntityState.fromChannels(shape, bones[index], skins[index])
+            derived._share()
+            baseBones, baseSkins = self._records[keyframe][:2]
+            self._records[keyframe] = (
+                baseBones, baseSkins, derived, (derived._boneData, derived._skinData))
+            keyframe.entityState = derived
+
+
+class RetargetLibrary(object):
+    """
+    The animations of an AnimationSet, prepared for retargeting. The first
+    keyframe of the animation named restName is the reference pose; the
+    rest animation itself isn't retargeted.
+    """
+    def __init__(self, animationSet, restName='rest'):
+        self.restName = restName
+        restAnimation = animationSet.animationByName.get(restName, None)
+        if not restAnimation or not restAnimation.keyframes:
+            raise ValueError('%s has no %r animation' % (animationSet.name, restName))
+        restState = restAnimation.keyframes[0].entityState
+        self.shape = restState.shape
+        self.restBones = restState.boneChannels.copy()
+        self.restSkins = restState.skinChannels.copy()
+        self.animations = []
+        for animation in animationSet.animations:
+            if animation is restAnimation or not animation.keyframes:
+                continue
+            keyframes = animation.keyframes
+            for keyframe in keyframes:
+                if keyframe.entityState.shape != self.shape:
+                    raise ValueError('The keyframes of %s differ in shape' % animation.name)
+            self.animations.append(dict(
+                id=animation.id,
+                name=animation.name,
+                length=animation.length,
+                looping=animation.looping,
+                keyframes=[(k.time, k.spin) for k in keyframes],
+                bones=numpy.array([k.entityState.boneChannels for k in keyframes]),
+                skins=numpy.array([k.entityState.skinChannels for k in keyframes]),
+            ))
+
+    def retarget(self, targetSet, restName=None):
+        """
+        Returns a new AnimationSet for the rig of targetSet: its rest
+        animation followed by every animation of the library, corrected by
+        the difference between the two rest poses. Bones and skins are
+        matched by name, so the rigs may order them differently.
+        """
+        restName = restName or self.restName
+        restAnimation = targetSet.animationByName.get(restName, None)
+        if not restAnimation or not restAnimation.keyframes:
+            raise ValueError('%s has no %r animation' % (targetSet.name, restName))
+        targetState = restAnimation.keyframes[0].entityState
+        targetShape = targetState.shape
+        boneIndex = objectIndex(self.shape[0], targetShape[0], 'bone')
+        skinIndex = objectIndex(self.shape[1], targetShape[1], 'skin')
+        # the difference between the rest poses, in the target's order
+        deltaBones = pose.difference(
+            self.restBones[boneIndex], targetState.boneChannels,
+            numpy.empty_like(targetState.boneChannels))
+        deltaSkins = pose.difference(
+            self.restSkins[skinIndex], targetState.skinChannels,
+            numpy.empty_like(targetState.skinChannels))
+
+        animationSet = AnimationSet()
+        animationSet.id = targetSet.id
+        animationSet.name = targetSet.name
+        animationSet.addAnimation(restAnimation)
+        for data in self.animations:
+            bones = data['bones'][:, boneIndex]
+            skins = data['skins'][:, skinIndex]
+            pose.combine(bones, deltaBones, bones)
+            pose.combine(skins, deltaSkins, skins)
+            animation = Animation()
+            animation.id = len(animationSet.animations)
+            animation.name = data['name']
+            animation.length = data['length']
+            animation.looping = data['looping']
+            for keyId, (time, spin) in enumerate(data['keyframes']):
+                entityState = EntityState.fromChannels(targetShape, bones[keyId], skins[keyId])
+                keyframe = Keyframe(keyId, time, entityState)
+                keyframe.spin = spin
+                animation.addKeyframe(keyframe)
+            animationSet.addAnimation(animation)
+        return animationSet
+
+
+def objectIndex(sourceShape, targetShape, kind='bone'):
+    """
+    Returns an array with the index in sourceShape of each object of
+    targetShape, matching them by name. Unnamed or missing (None) objects
+    are matched by position instead.
+    """
+    sourceIds = {}
+    for sourceId, meta in enumerate(sourceShape):
+        if meta is not None and meta[0]:
+            sourceIds.setdefault(meta[0], sourceId)
+    index = numpy.zeros(len(targetShape), dtype=numpy.intp)
+    for targetId, meta in enumerate(targetShape):
+        if meta is not None and meta[0]:
+            if meta[0] not in sourceIds:
+                raise ValueError('The source has no %s named %r' % (kind, meta[0]))
+            index[targetId] = sourceIds[meta[0]]
+        elif targetId < len(sourceShape):
+            index[targetId] = targetId
+        elif meta is not None:
+            raise ValueError('The source has no %s %d' % (kind, targetId))
+    return index
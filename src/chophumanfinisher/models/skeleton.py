@@ -4,6 +4,7 @@ NOTE: At this point, only the Limb class and its skeletal definitions are used.
 """
 import math
 from PyQt4 import QtCore
+from . import pose
 
 
 TWO_PI = 2 * math.pi
@@ -34,31 +35,81 @@ def _lerpAngle(a0, a1, t, spin):
         else:
             angle = _lerp(a0, a1, t)
     else:
-        if abs(a0 - a1) > HALF_CIRCLE:
+        # shortest arc
+        if a1 - a0 > HALF_CIRCLE:
+            a1 -= FULL_CIRCLE
+        elif a0 - a1 > HALF_CIRCLE:
             a1 += FULL_CIRCLE
         angle = _lerp(a0, a1, t)
     return angle
 
 
-class Transform(object):
-    x = 0
-    y = 0
-    angle = 0.0
-    scaleX = 1.0
-    scaleY = 1.0
-    spin = 0
-    
+def _channelProperty(channel, cast=float):
+    def getter(self):
+        return cast(self._channels[channel])
+    def setter(self, value):
+        self._writableChannels()[channel] = value
+    return property(getter, setter)
+
+
+class ChannelView(object):
+    """
+    Base for objects whose data lives in a row of channels (see models.pose).
+    Standalone objects own their row while the bones and skins of an
+    EntityState refer to rows of the state's channel arrays. Those arrays
+    are read-only while they are shared with a clone of the state, so the
+    first write asks the owning state for a private copy, and every write
+    marks the row as changed for EntityState.flatten.
+    There are many of these, so they use __slots__ rather than a __dict__.
+    """
+    __slots__ = ('_channels', '_owner')
+
+    def __init__(self, channels, owner=None):
+        self._channels = channels
+        self._owner = owner
+
+    def attachChannels(self, channels, owner=None):
+        self._channels = channels
+        self._owner = owner
+
+    def bindChannels(self, channels, owner=None):
+        """Moves this object's data into `channels` and attaches to them."""
+        channels[...] = self._channels
+        self.attachChannels(channels, owner)
+
+    def _writableChannels(self):
+        owner = self._owner
+        if owner is not None:
+            if not self._channels.flags.writeable:
+                owner._detach()
+            owner._channelsWritten(self._channels)
+        return self._channels
+
+
+class Transform(ChannelView):
+    """
+    A view over a row of transform channels.
+    """
+    __slots__ = ()
+    x = _channelProperty(pose.X)
+    y = _channelProperty(pose.Y)
+    angle = _channelProperty(pose.ANGLE)
+    scaleX = _channelProperty(pose.SCALE_X)
+    scaleY = _channelProperty(pose.SCALE_Y)
+    spin = _channelProperty(pose.SPIN, int)
+
+    def __init__(self, channels=None, owner=None):
+        if channels is None:
+            channels = pose.newChannels(pose.TRANSFORM_DEFAULTS)
+        super(Transform, self).__init__(channels, owner)
+
     @property
     def angleRadians(self):
         return self.angle * DEGREE_TO_RADIAN
     
     def copy(self, other):
-        self.x = other.x
-        self.y = other.y
-        self.angle = other.angle
-        self.scaleX = other.scaleX
-        self.scaleY = other.scaleY
-        self.spin = other.spin
+        self._writableChannels()[:pose.TRANSFORM_CHANNELS] = \
+            other._channels[:pose.TRANSFORM_CHANNELS]
 
     def clone(self):
         transform = Transform()
@@ -118,18 +169,33 @@ class Transform(object):
 
 
 
-class SceneObject(object):
-    id = None
-    name = ''
-    parent = None
-    children = None
-    transform = None
+class SceneObject(ChannelView):
+    __slots__ = ('id', 'name', 'parent', 'children', '_transform')
+    channelDefaults = pose.TRANSFORM_DEFAULTS
 
     def __init__(self):
-        self.children = []
-        self.transform = Transform()
+        super(SceneObject, self).__init__(pose.newChannels(self.channelDefaults))
+        self.id = None
+        self.name = ''
+        self.parent = None
+        self.children = None
+        self._transform = None
+
+    @property
+    def transform(self):
+        """A Transform over the same channels, created when first used."""
+        if self._transform is None:
+            self._transform = Transform(self._channels, self._owner)
+        return self._transform
+
+    def attachChannels(self, channels, owner=None):
+        super(SceneObject, self).attachChannels(channels, owner)
+        if self._transform is not None:
+            self._transform.attachChannels(channels, owner)
 
     def addChild(self, child):
+        if self.children is None:
+            self.children = []
         self.children.append(child)
         child.parent = self
 
@@ -138,7 +204,7 @@ class SceneObject(object):
         child.parent = None
 
     def childCount(self):
-        return len(self.children)
+        return len(self.children or ())
 
     def indexOf(self, child):
         self.children.index(child)
@@ -178,6 +244,8 @@ class SceneObject(object):
 
 
 class Bone(SceneObject):
+    __slots__ = ()
+
     def copy(self, other):
         super(Bone, self).copy(other)
 
@@ -188,20 +256,22 @@ class Bone(SceneObject):
 
 
 class Skin(SceneObject):
-    diffusemap = None
-    normalmap = None
-    mask = None
-    pivotX = 0.0
-    pivotY = 0.0
-    opacity = 1.0
-    zIndex = 0
+    __slots__ = ('diffusemap', 'normalmap', 'mask')
+    pivotX = _channelProperty(pose.PIVOT_X)
+    pivotY = _channelProperty(pose.PIVOT_Y)
+    opacity = _channelProperty(pose.OPACITY)
+    zIndex = _channelProperty(pose.Z_INDEX, int)
+    channelDefaults = pose.SKIN_DEFAULTS
+
+    def __init__(self):
+        super(Skin, self).__init__()
+        self.diffusemap = None
+        self.normalmap = None
+        self.mask = None
 
     def copy(self, other):
         super(Skin, self).copy(other)
-        self.pivotX = other.pivotX
-        self.pivotY = other.pivotY
-        self.opacity = other.opacity
-        self.zIndex = other.zIndex
+        self._writableChannels()[pose.PIVOT_X:] = other._channels[pose.PIVOT_X:]
 
     def clone(self):
         skin = Skin()
@@ -1,17 +1,67 @@
 """
-This script takes as input a target SCML file with a single rest pose animation
-and a different SCML file which contains a reference rest pose and a number of
-additional animations which are to be mapped to the target file.
-NOTE: doesn't yet do any of that
+This script takes as input a source SCML file which contains a reference rest
+pose (the first keyframe of its 'rest' animation) and a number of additional
+animations, and any number of target SCML files, each with a 'rest' animation
+posing its own rig. The source animations are mapped onto every target and
+written, with the target's images, to the output directory:
+
+    python src/retarget_animations.py -o out/ library.scml characters/*.scml
+
+The source is imported once per worker process and the targets are spread
+across the processes.
 """
+import argparse
+import multiprocessing
+import os
 import sys
-from chophumanfinisher.importers.scml import SCMLImporter
+from chophumanfinisher import batch
+from chophumanfinisher.cli import runTasks
+from chophumanfinisher.models.retarget import RetargetLibrary
+
+
+# the source library of the current worker process, see loadLibrary
+library = None
+
+
+def loadLibrary(sourcePath, restName, useCache):
+    global library
+    animationSets, _ = batch.importFile(sourcePath, useCache)
+    library = RetargetLibrary(animationSets[0], restName)
+
+
+def retargetFile(targetPath, options):
+    animationSets, skinFileMap = batch.importFile(targetPath, options.useCache)
+    animationSet = library.retarget(animationSets[0])
+    outputFilepath = os.path.join(options.outputPath, os.path.basename(targetPath))
+    if os.path.abspath(outputFilepath) == os.path.abspath(targetPath):
+        raise ValueError('refusing to overwrite the input file')
+    batch.exportFile([animationSet], skinFileMap, outputFilepath)
+    return '%d animations' % (len(animationSet.animations) - 1)
+
+
+def makeParser():
+    parser = argparse.ArgumentParser(
+        description='Maps the animations of one SCML file onto other rigs.')
+    parser.add_argument('source', metavar='SOURCE', help='SCML file with the animations')
+    parser.add_argument('targets', nargs='+', metavar='TARGET', help='SCML files of the rigs')
+    parser.add_argument('-o', '--output', dest='outputPath', required=True,
+        help='directory to write the retargeted files to')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+        help='number of worker processes (default: one per cpu)')
+    parser.add_argument('--rest', dest='restName', default='rest',
+        help='name of the rest pose animation (default: rest)')
+    parser.add_argument('--no-cache', dest='useCache', action='store_false',
+        help="don't read or write the .chcache files of the inputs")
+    return parser
 
 
 if __name__ == '__main__':
-    targetFilename = sys.argv[-1]
-    print('importing %s' % targetFilename)
-    targetImporter = SCMLImporter()
-    animationSets = targetImporter.importFile(targetFilename)
-    print('%s' % animationSets[0])
-    
\ No newline at end of file
+    options = makeParser().parse_args()
+    if not os.path.isdir(options.outputPath):
+        os.makedirs(options.outputPath)
+    tasks = [(retargetFile, path, options) for path in options.targets]
+    failures = runTasks(
+        'retarget', tasks, options.jobs,
+        loadLibrary, (options.source, options.restName, options.useCache)
+    )
+    sys.exit(1 if failures else 0)